@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Exaplanation: sumobench measures end to end query throughput of the run cmdlets against sumomock
+
+Usage:
+   $ python  sumobench [ options ] [ cmdlet ... ]
+
+   Each cmdlet runs a query against a local MockSumoServer returning each of
+   the -n sizes of results. The wall time, the records/sec, the requests the
+   server saw, the megabytes the cmdlet received and sent, and the peak RSS
+   of the cmdlet are reported as csv.
+
+Style:
+   Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+    @name           sumobench
+    @version        1.00
+    @author-name    Wayne Schmidt
+    @author-email   wschmidt@sumologic.com
+    @license-name   Apache 2.0
+    @license-url    http://www.gnu.org/licenses/gpl.html
+"""
+
+__version__ = 1.00
+__author__ = "Wayne Schmidt (wschmidt@sumologic.com)"
+
+### beginning ###
+import argparse
+import json
+import os
+import shlex
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+sys.dont_write_bytecode = 1
+
+from sumomock import MockSumoServer
+
+PARSER = argparse.ArgumentParser(description="""
+sumobench runs the query cmdlets against sumomock and reports their throughput
+""")
+
+PARSER.add_argument("-n", metavar='<sizes>', default='10k,100k,1m,5m', dest='SIZES', \
+                    help="set comma separated result sizes, with k and m suffixes")
+PARSER.add_argument("-g", metavar='<seconds>', type=float, default=1.0, dest='GATHER', \
+                    help="set time a search job takes to gather its results")
+PARSER.add_argument("-l", metavar='<seconds>', type=float, default=0.0, dest='LATENCY', \
+                    help="set latency the server adds to every response")
+PARSER.add_argument("-e", metavar='<rate>', type=float, default=0.0, dest='ERROR_RATE', \
+                    help="set share of api requests answered with a 429 or a 503")
+PARSER.add_argument("-r", metavar='<persecond>', type=float, default=0, dest='API_RATE', \
+                    help="set --rate passed to the cmdlets, 0 leaves them unpaced")
+PARSER.add_argument("-a", metavar='<args>', default='', dest='EXTRA_ARGS', \
+                    help="set extra arguments passed to sumoquery, such as '-f 8 -z gzip'")
+PARSER.add_argument("-T", metavar='<seconds>', type=int, default=600, dest='TIMEOUT', \
+                    help="set time allowed per run before it is stopped")
+PARSER.add_argument("-o", metavar='<file>', dest='JSON_OUTPUT', \
+                    help="also write the results as json to a file")
+PARSER.add_argument("-v", type=int, default=0, metavar='<verbose>', \
+                    dest='VERBOSE', help="increase verbosity")
+PARSER.add_argument("cmdlets", metavar='cmdlet', nargs='*', \
+                    default=['sumoquery', 'run_report', 'sumoquerystream'], \
+                    help="cmdlets to run (default: sumoquery run_report sumoquerystream)")
+
+ARGS = PARSER.parse_args()
+
+RUNDIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bin', 'run')
+
+BENCH_TARGET = 'bench_sumobench'
+
+QUERY_EXT = '.sqy'
+
+BENCH_QUERY = '_sourcecategory=bench/* | timeslice 1m | count by _timeslice, _sourcecategory'
+
+SIZE_SUFFIX = {'k': 1000, 'm': 1000000}
+
+CSV_SEP = ','
+
+KB_M = 1024
+
+### beginning ###
+
+def main():
+    """
+    Start the server, run every cmdlet at every size, and print a csv line per run
+    """
+    sizes = [ parse_size(size) for size in ARGS.SIZES.split(',') ]
+
+    mock = MockSumoServer(gather=ARGS.GATHER, latency=ARGS.LATENCY, \
+                          error_rate=ARGS.ERROR_RATE).start()
+    results = []
+    print(CSV_SEP.join(('cmdlet', 'records', 'status', 'wall_s', 'records_per_sec', \
+                        'requests', 'errors_injected', 'mb_received', 'mb_sent', \
+                        'peak_rss_mb')))
+    try:
+        with tempfile.TemporaryDirectory(prefix='sumobench.') as workdir:
+            for cmdlet in ARGS.cmdlets:
+                for size in sizes:
+                    result = run_benchmark(mock, cmdlet, size, workdir)
+                    report_benchmark(result)
+                    results.append(result)
+    finally:
+        mock.stop()
+
+    if ARGS.JSON_OUTPUT:
+        with open(ARGS.JSON_OUTPUT, "w", encoding='utf8') as json_object:
+            json.dump(results, json_object, indent=4)
+
+def parse_size(size):
+    """
+    Turn 10k or 5m into a number of results
+    """
+    size = size.strip().lower()
+    if size[-1:] in SIZE_SUFFIX:
+        return int(float(size[:-1]) * SIZE_SUFFIX[size[-1]])
+    return int(size)
+
+def build_command(cmdlet, workdir):
+    """
+    Build the command line of a cmdlet, pointed at the work directory and unpaced.
+    run_report only takes queries from files, so the query is written to one.
+    """
+    query_file = os.path.join(workdir, 'sumobench' + QUERY_EXT)
+    with open(query_file, "w", encoding='utf8') as query_object:
+        query_object.write(BENCH_QUERY)
+
+    rate_args = ['--rate', str(ARGS.API_RATE)]
+    if cmdlet == 'sumoquery':
+        return ['sumoquery.py', '-t', BENCH_TARGET, '-q', query_file, '-r', '1h', '-s', '1', \
+                '-d', os.path.join(workdir, 'sumoquery')] + rate_args + \
+                shlex.split(ARGS.EXTRA_ARGS)
+    if cmdlet == 'run_report':
+        return ['run_report.py', '-t', BENCH_TARGET, '-q', query_file, '-r', '1h'] + rate_args
+    return ['sumoquerystream.py', '-r', '1h', '-s', '1'] + rate_args
+
+def build_environment(mock):
+    """
+    Point every flavour of credentials and endpoint the cmdlets read at the server
+    """
+    environment = dict(os.environ)
+    environment.update({'SUMO_UID': 'sumobench', 'SUMO_KEY': 'sumobench', \
+                        'SUMO_ACCESS_ID': 'sumobench', 'SUMO_ACCESS_KEY': 'sumobench', \
+                        'SUMO_END': mock.url + '/api', \
+                        'SUMO_URL': mock.url + '/receiver/v1/http/sumobench', \
+                        'DEFAULT_QUERY': BENCH_QUERY, 'LOGLEVEL': 'WARNING'})
+    environment.pop('SUMO_API_RATE', None)
+    return environment
+
+def run_benchmark(mock, cmdlet, size, workdir):
+    """
+    Run one cmdlet for one size of results, and collect what it took
+    """
+    mock.reset()
+    mock.settings['records'] = size
+    command = [sys.executable] + build_command(cmdlet, workdir)
+    command[1] = os.path.join(RUNDIR, command[1])
+    if ARGS.VERBOSE > 2:
+        print(' '.join(shlex.quote(word) for word in command), file=sys.stderr)
+
+    output = None if ARGS.VERBOSE > 3 else subprocess.DEVNULL
+    start_time = time.perf_counter()
+    process = subprocess.Popen(command, cwd=workdir, env=build_environment(mock), \
+                               stdout=output, stderr=output)
+    (returncode, rusage) = wait_for(process, start_time + ARGS.TIMEOUT)
+    wall_time = time.perf_counter() - start_time
+
+    status = 'ok'
+    if returncode is None:
+        status = 'timeout'
+    elif returncode != 0:
+        status = 'error'
+
+    stats = dict(mock.stats)
+    return {'cmdlet': cmdlet, 'records': size, 'status': status, 'wall_s': wall_time, \
+            'records_per_sec': size / wall_time if status == 'ok' else 0, \
+            'requests': sum(count for name, count in stats.items() \
+                            if name.startswith('requests_')), \
+            'errors_injected': stats.get('errors_429', 0) + stats.get('errors_503', 0), \
+            'bytes_received': stats.get('bytes_sent', 0), \
+            'bytes_sent': stats.get('bytes_received', 0), \
+            'peak_rss_mb': rusage.ru_maxrss / KB_M if rusage else 0, \
+            'server': stats}
+
+def wait_for(process, deadline):
+    """
+    Wait for a process, returning its exit code and resource usage, or no exit
+    code when it had to be stopped at the deadline
+    """
+    while True:
+        (pid, status, rusage) = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            process.returncode = os.waitstatus_to_exitcode(status)
+            return (process.returncode, rusage)
+        if time.perf_counter() > deadline:
+            process.send_signal(signal.SIGKILL)
+            (_pid, _status, rusage) = os.wait4(process.pid, 0)
+            process.returncode = -signal.SIGKILL
+            return (None, rusage)
+        time.sleep(0.05)
+
+def report_benchmark(result):
+    """
+    Print one csv line for a run
+    """
+    print(CSV_SEP.join((result['cmdlet'], str(result['records']), result['status'], \
+                        f'{result["wall_s"]:.2f}', f'{result["records_per_sec"]:.0f}', \
+                        str(result['requests']), str(result['errors_injected']), \
+                        f'{result["bytes_received"] / KB_M / KB_M:.1f}', \
+                        f'{result["bytes_sent"] / KB_M / KB_M:.1f}', \
+                        f'{result["peak_rss_mb"]:.0f}')), flush=True)
+    if ARGS.VERBOSE > 1:
+        print(f'    {json.dumps(result["server"], sort_keys=True)}', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Exaplanation: sumomock is a local stand in for the Sumo Logic search job api and http receiver
+
+Usage:
+   $ python  sumomock [ options ]
+
+   from sumomock import MockSumoServer
+
+   Point a cmdlet at it with SUMO_END=http://127.0.0.1:<port>/api, and for
+   sumoquerystream SUMO_URL=http://127.0.0.1:<port>/receiver/v1/http/<anything>.
+   GET /stats returns what it has served, events by X-Sumo-Category included,
+   POST /stats resets the counts.
+
+Style:
+   Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+    @name           sumomock
+    @version        1.00
+    @author-name    Wayne Schmidt
+    @author-email   wschmidt@sumologic.com
+    @license-name   Apache 2.0
+    @license-url    http://www.gnu.org/licenses/gpl.html
+"""
+
+__version__ = 1.00
+__author__ = "Wayne Schmidt (wschmidt@sumologic.com)"
+
+### beginning ###
+import argparse
+import collections
+import functools
+import gzip
+import http.server
+import itertools
+import json
+import random
+import threading
+import time
+import urllib.parse
+
+JOB_PATH = '/api/v1/search/jobs'
+RECEIVER_PATH = '/receiver/'
+STATS_PATH = '/stats'
+
+RECORD_FIELDS = [
+    {'name': '_timeslice', 'fieldType': 'long', 'keyField': True},
+    {'name': '_sourcecategory', 'fieldType': 'string', 'keyField': True},
+    {'name': '_collector', 'fieldType': 'string', 'keyField': True},
+    {'name': 'bytes', 'fieldType': 'double', 'keyField': False},
+    {'name': '_count', 'fieldType': 'long', 'keyField': False},
+]
+MESSAGE_FIELDS = [
+    {'name': '_messagetime', 'fieldType': 'long', 'keyField': False},
+    {'name': '_sourcecategory', 'fieldType': 'string', 'keyField': False},
+    {'name': '_raw', 'fieldType': 'string', 'keyField': False},
+]
+
+SLICE_MS = 60000
+
+### beginning ###
+
+### class ###
+class MockSumoServer():
+    """
+    This is a threaded http server acting out the search job api. Jobs go from
+    NOT STARTED through GATHERING RESULTS to DONE GATHERING RESULTS over the
+    gather time, their counts growing as they go. Records and messages are
+    paged with limit and offset. Every response can be delayed by a latency,
+    and a share of them can be answered with a 429 or a 503 instead.
+    """
+
+    def __init__(self, port=0, records=10000, gather=1.0, latency=0.0, \
+                 error_rate=0.0, retry_after=1):
+        """
+        Initializes the server settings, the jobs and the counters
+        """
+        self.settings = {'records': records, 'gather': gather, 'latency': latency, \
+                         'error_rate': error_rate, 'retry_after': retry_after}
+        self.jobs = {}
+        self.job_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', port), MockSumoHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = self
+        self.thread = None
+
+    @property
+    def url(self):
+        """
+        The base url of the server
+        """
+        return f'http://127.0.0.1:{self.httpd.server_address[1]}'
+
+    def start(self):
+        """
+        Serve on a background thread, for use inside another program
+        """
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving and close the socket
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count(self, name, amount=1):
+        """
+        Add to one of the counters
+        """
+        with self.lock:
+            self.stats[name] += amount
+
+    def reset(self):
+        """
+        Clear the counters and forget the jobs
+        """
+        with self.lock:
+            self.stats.clear()
+            self.jobs.clear()
+
+    def create_job(self, job_request):
+        """
+        Start a job, fixing how many results it will have
+        """
+        query_jobid = f'{next(self.job_ids):016X}'
+        with self.lock:
+            self.jobs[query_jobid] = {'start': time.time(), 'query': job_request.get('query'), \
+                                      'results': self.settings['records']}
+        return query_jobid
+
+    def job_status(self, query_jobid):
+        """
+        Work out the state and counts of a job from how long it has been running
+        """
+        job = self.jobs.get(query_jobid)
+        if job is None:
+            return None
+        gather = self.settings['gather']
+        progress = 1.0 if gather <= 0 else min(1.0, (time.time() - job['start']) / gather)
+        if progress < 0.1:
+            state = 'NOT STARTED'
+        elif progress < 1.0:
+            state = 'GATHERING RESULTS'
+        else:
+            state = 'DONE GATHERING RESULTS'
+        count = int(job['results'] * progress)
+        return {'state': state, 'messageCount': count, 'recordCount': count, \
+                'pendingWarnings': [], 'pendingErrors': []}
+
+### class ###
+
+class MockSumoHandler(http.server.BaseHTTPRequestHandler):
+    """
+    This answers one request on behalf of the MockSumoServer
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *_args):
+        """
+        Keep quiet, the counters say what was served
+        """
+
+    def reply(self, status, body, headers=None):
+        """
+        Send a json reply, after the latency
+        """
+        mock = self.server.mock
+        if mock.settings['latency'] > 0:
+            time.sleep(mock.settings['latency'])
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+        mock.count('bytes_sent', len(body))
+
+    def read_body(self):
+        """
+        Read the request body, unzipping it when it is gzip encoded
+        """
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.mock.count('bytes_received', len(body))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def inject_error(self):
+        """
+        Answer with a 429 or a 503 for a share of api requests, True when one was sent
+        """
+        mock = self.server.mock
+        if mock.settings['error_rate'] <= 0 or random.random() >= mock.settings['error_rate']:
+            return False
+        status = random.choice((429, 503))
+        mock.count(f'errors_{status}')
+        self.reply(status, {'status': status, 'message': 'injected by sumomock'}, \
+                   {'Retry-After': str(mock.settings['retry_after'])})
+        return True
+
+    def do_POST(self):
+        """
+        Create a search job, take events on the receiver, or reset the counters
+        """
+        mock = self.server.mock
+        path = urllib.parse.urlparse(self.path).path
+        body = self.read_body()
+        if path == STATS_PATH:
+            mock.reset()
+            self.reply(200, {})
+        elif path.startswith(RECEIVER_PATH):
+            mock.count('requests_receiver')
+            events = body.count(b'\n') + (0 if body.endswith(b'\n') else 1)
+            mock.count('events', events)
+            mock.count('events_' + self.headers.get('X-Sumo-Category', 'none'), events)
+            self.reply(200, b'')
+        elif path == JOB_PATH:
+            mock.count('requests_create')
+            if not self.inject_error():
+                self.reply(202, {'id': mock.create_job(json.loads(body or b'{}')), \
+                                 'link': {'rel': 'self', 'href': JOB_PATH}})
+        else:
+            self.reply(404, {'message': 'not found'})
+
+    def do_DELETE(self):
+        """
+        Delete a search job
+        """
+        mock = self.server.mock
+        query_jobid = urllib.parse.urlparse(self.path).path.rstrip('/').split('/')[-1]
+        mock.count('requests_delete')
+        with mock.lock:
+            job = mock.jobs.pop(query_jobid, None)
+        self.reply(200 if job else 404, {'id': query_jobid})
+
+    def do_GET(self):
+        """
+        Report job status, page records or messages, or return the counters
+        """
+        mock = self.server.mock
+        parsed = urllib.parse.urlparse(self.path)
+        if parsed.path == STATS_PATH:
+            with mock.lock:
+                self.reply(200, dict(mock.stats))
+            return
+        if not parsed.path.startswith(JOB_PATH + '/'):
+            mock.count('requests_other')
+            self.reply(200, {})
+            return
+
+        parts = parsed.path[len(JOB_PATH) + 1:].split('/')
+        kind = parts[1] if len(parts) > 1 else 'status'
+        mock.count(f'requests_{kind}')
+        if self.inject_error():
+            return
+        status = mock.job_status(parts[0])
+        if status is None:
+            self.reply(404, {'status': 404, 'code': 'searchjob.jobid.invalid'})
+        elif kind == 'status':
+            self.reply(200, status)
+        elif kind in ('records', 'messages'):
+            params = urllib.parse.parse_qs(parsed.query)
+            offset = int(params.get('offset', ['0'])[0])
+            limit = int(params.get('limit', ['10000'])[0])
+            end = min(offset + limit, status['recordCount'])
+            mock.count(f'{kind}_served', max(0, end - offset))
+            self.reply(200, render_page(kind, offset, end))
+        else:
+            self.reply(404, {'message': 'not found'})
+
+def render_page(kind, offset, end):
+    """
+    Render a page of synthetic records or messages. Results only depend on their
+    position, so the same page renders the same for every job.
+    """
+    return _render_page(kind, offset, max(offset, end))
+
+@functools.lru_cache(maxsize=32)
+def _render_page(kind, offset, end):
+    """
+    Render and remember a page, so repeated runs do not pay for it again
+    """
+    if kind == 'records':
+        results = [ {'map': {'_timeslice': str(1600000000000 + (row // 100) * SLICE_MS), \
+                             '_sourcecategory': f'bench/category/{row % 100}', \
+                             '_collector': f'collector-{row % 7}', \
+                             'bytes': str(row * 1.5), '_count': str(row % 1000)}} \
+                    for row in range(offset, end) ]
+        return json.dumps({'fields': RECORD_FIELDS, 'records': results}).encode('utf8')
+    results = [ {'map': {'_messagetime': str(1600000000000 + row), \
+                         '_sourcecategory': f'bench/category/{row % 100}', \
+                         '_raw': f'{{"level":"info","message":"synthetic message {row}"}}'}} \
+                for row in range(offset, end) ]
+    return json.dumps({'fields': MESSAGE_FIELDS, 'messages': results}).encode('utf8')
+
+def main():
+    """
+    Run the server in the foreground until interrupted
+    """
+    parser = argparse.ArgumentParser(description="""
+    sumomock stands in for the Sumo Logic search job api
+    """)
+    parser.add_argument("-p", metavar='<port>', type=int, default=8089, dest='PORT', \
+                        help="set port to listen on")
+    parser.add_argument("-n", metavar='<results>', type=int, default=10000, dest='RECORDS', \
+                        help="set number of records and messages every job returns")
+    parser.add_argument("-g", metavar='<seconds>', type=float, default=1.0, dest='GATHER', \
+                        help="set time a job takes to gather its results")
+    parser.add_argument("-l", metavar='<seconds>', type=float, default=0.0, dest='LATENCY', \
+                        help="set latency added to every response")
+    parser.add_argument("-e", metavar='<rate>', type=float, default=0.0, dest='ERROR_RATE', \
+                        help="set share of api requests answered with a 429 or a 503")
+    parser.add_argument("-r", metavar='<seconds>', type=int, default=1, dest='RETRY_AFTER', \
+                        help="set Retry-After sent with injected errors")
+    args = parser.parse_args()
+
+    mock = MockSumoServer(args.PORT, args.RECORDS, args.GATHER, args.LATENCY, \
+                          args.ERROR_RATE, args.RETRY_AFTER)
+    print(f'sumomock listening on {mock.url}/api')
+    try:
+        mock.httpd.serve_forever()
+    except KeyboardInterrupt:
+        mock.stop()
+
+if __name__ == '__main__':
+    main()
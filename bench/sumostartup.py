@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Exaplanation: sumostartup measures the startup time of the bin/ cmdlets against a budget
+
+Usage:
+   $ python  sumostartup [ options ] [ cmdlet ... ]
+
+   Each cmdlet is started with -h under python -X importtime, so only the
+   interpreter start and the imports of the cmdlet are timed.
+
+Style:
+   Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+    @name           sumostartup
+    @version        1.00
+    @author-name    Wayne Schmidt
+    @author-email   wschmidt@sumologic.com
+    @license-name   Apache 2.0
+    @license-url    http://www.gnu.org/licenses/gpl.html
+"""
+
+__version__ = 1.00
+__author__ = "Wayne Schmidt (wschmidt@sumologic.com)"
+
+### beginning ###
+import argparse
+import glob
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+sys.dont_write_bytecode = 1
+
+PARSER = argparse.ArgumentParser(description="""
+sumostartup reports how long each cmdlet takes to start, and which imports it spends it on
+""")
+
+PARSER.add_argument("-b", metavar='<budget>', type=int, default=400, dest='BUDGET', \
+                    help="set startup budget per cmdlet in milliseconds")
+PARSER.add_argument("-r", metavar='<runs>', type=int, default=3, dest='RUNS', \
+                    help="set number of runs per cmdlet, the median is reported")
+PARSER.add_argument("-n", metavar='<imports>', type=int, default=3, dest='TOP', \
+                    help="set number of heaviest imports listed per cmdlet")
+PARSER.add_argument("-v", type=int, default=0, metavar='<verbose>', \
+                    dest='VERBOSE', help="increase verbosity")
+PARSER.add_argument("cmdlets", metavar='cmdlet', nargs='*', \
+                    help="cmdlets to measure (default: every bin/*/*.py)")
+
+ARGS = PARSER.parse_args()
+
+BINDIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bin')
+
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+USEC_M = 1000
+
+CSV_SEP = ','
+
+### beginning ###
+
+def main():
+    """
+    Measure the interpreter on its own, then every cmdlet, and exit non zero
+    when any cmdlet goes over the budget
+    """
+    cmdlets = ARGS.cmdlets or sorted(glob.glob(os.path.join(BINDIR, '*', '*.py')))
+
+    print(CSV_SEP.join(('cmdlet', 'wall_ms', 'import_ms', 'status', 'heaviest_imports')))
+
+    baseline = measure_startup(['-c', 'pass'])
+    report_startup('python', baseline, budget=None)
+
+    over_budget = 0
+    for cmdlet in cmdlets:
+        startup = measure_startup([cmdlet, '-h'])
+        over_budget += report_startup(os.path.relpath(cmdlet), startup, ARGS.BUDGET)
+
+    if over_budget:
+        print(f'{over_budget} of {len(cmdlets)} cmdlets over the {ARGS.BUDGET}ms budget', \
+              file=sys.stderr)
+        sys.exit(1)
+
+def measure_startup(command_args):
+    """
+    Run a command under -X importtime and return the median wall time, the
+    median import time and the top level imports of the last run
+    """
+    wall_times = []
+    import_times = []
+    top_imports = {}
+    returncode = 0
+    for _run in range(max(1, ARGS.RUNS)):
+        start_time = time.perf_counter()
+        completed = subprocess.run([sys.executable, '-X', 'importtime'] + command_args, \
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, \
+                                   text=True, check=False)
+        wall_times.append((time.perf_counter() - start_time) * USEC_M)
+        returncode = completed.returncode
+        top_imports = parse_import_times(completed.stderr)
+        import_times.append(sum(top_imports.values()) / USEC_M)
+
+    return {'wall_ms': statistics.median(wall_times), \
+            'import_ms': statistics.median(import_times), \
+            'imports': top_imports, 'returncode': returncode}
+
+def parse_import_times(importtime_output):
+    """
+    Read the cumulative microseconds of each top level import from -X importtime output
+    """
+    top_imports = {}
+    for line in importtime_output.splitlines():
+        import_match = IMPORT_LINE.match(line)
+        if import_match and import_match.group(3) == ' ':
+            top_imports[import_match.group(4)] = int(import_match.group(2))
+    return top_imports
+
+def report_startup(cmdlet, startup, budget):
+    """
+    Print one line for a cmdlet, and return 1 when it is over budget
+    """
+    heaviest = sorted(startup['imports'].items(), key=lambda item: item[1], reverse=True)
+    heaviest_imports = ' '.join(f'{name}:{cumulative / USEC_M:.0f}ms' \
+                                for name, cumulative in heaviest[:ARGS.TOP])
+    status = 'ok'
+    if startup['returncode'] != 0:
+        status = 'error'
+    elif budget is not None and startup['wall_ms'] > budget:
+        status = 'over'
+    print(CSV_SEP.join((cmdlet, f'{startup["wall_ms"]:.0f}', f'{startup["import_ms"]:.0f}', \
+                        status, heaviest_imports)))
+    if ARGS.VERBOSE > 3:
+        for name, cumulative in heaviest:
+            print(f'    {name}: {cumulative / USEC_M:.1f}ms')
+    return 1 if status == 'over' else 0
+
+if __name__ == '__main__':
+    main()
@@ -31,6 +31,8 @@ import argparse
 import http
 import requests
 sys.dont_write_bytecode = 1
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sumoprofile import start_profile
 
 MY_CFG = 'undefined'
 PARSER = argparse.ArgumentParser(description="""
@@ -56,8 +58,11 @@ PARSER.add_argument("-o", metavar='<overrides>', action='append', \
                     dest='overrides', help="specify override (format: key=value )")
 PARSER.add_argument("-v", type=int, default=0, metavar='<verbose>', \
                     dest='verbose', help="Increase verbosity")
+PARSER.add_argument("--profile", metavar='<path>', dest='PROFILE', \
+                    help="profile the run into files named after path or use env var SUMO_PROFILE")
 
 ARGS = PARSER.parse_args()
+start_profile(ARGS.PROFILE)
 
 if ARGS.MY_SECRET:
     (MY_APINAME, MY_APISECRET) = ARGS.MY_SECRET.split(':')
@@ -6,6 +6,10 @@ import os
 import re
 import sys
 from benedict import benedict
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sumoprofile import start_profile
+
+start_profile()
 
 yaml_file = sys.argv[1]
 yaml_dir = os.path.dirname(os.path.abspath(yaml_file))
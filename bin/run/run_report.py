@@ -32,10 +32,16 @@ import argparse
 import http
 import re
 import time
+import collections
+import threading
 import requests
 from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
+from sumocache import ResultCache
+from sumolimit import RateLimiter, RetryBackoff, RETRY_STATUS, retry_safe
+from sumorecords import RecordSerializer
 sys.dont_write_bytecode = 1
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sumoprofile import start_profile
 
 MY_CFG = 'undefined'
 PARSER = argparse.ArgumentParser(description="""
@@ -53,8 +59,23 @@ PARSER.add_argument("-o", metavar='<fmt>', default="csv", dest='OUT_FORMAT', \
                     help="set query output (values: txt, csv)")
 PARSER.add_argument("-v", type=int, default=0, metavar='<verbose>', \
                     dest='VERBOSE', help="increase verbosity")
+PARSER.add_argument("--rate", metavar='<persecond>', type=float, default=4, dest='API_RATE', \
+                    help="set api calls per second shared by every run using this access id")
+PARSER.add_argument("--burst", metavar='<calls>', type=int, dest='API_BURST', \
+                    help="set api calls allowed at once before pacing (default: the rate)")
+PARSER.add_argument("--cache-ttl", metavar='<range>', dest='CACHE_TTL', \
+                    help="reuse the output of an identical query for this long (e.g. 15m)")
+PARSER.add_argument("--cache-align", metavar='<range>', default='5m', dest='CACHE_ALIGN', \
+                    help="snap the query range to this boundary when caching")
+PARSER.add_argument("--cache-size", metavar='<megabytes>', type=int, default=1024, \
+                    dest='CACHE_SIZE', help="set the size the query cache is evicted down to")
+PARSER.add_argument("--cache-bypass", default=False, action='store_true', dest='CACHE_BYPASS', \
+                    help="run queries even when cached, refreshing the cache")
+PARSER.add_argument("--profile", metavar='<path>', dest='PROFILE', \
+                    help="profile the run into files named after path or use env var SUMO_PROFILE")
 
 ARGS = PARSER.parse_args()
+start_profile(ARGS.PROFILE)
 
 SEC_M = 1000
 MIN_S = 60
@@ -63,6 +84,8 @@ DAY_H = 24
 WEEK_D = 7
 
 LIMIT = 10000
+
+POLL_STATES = ('NOT STARTED', 'GATHERING RESULTS', 'GATHERING RESULTS FROM SUBQUERIES')
 LONGQUERY_LIMIT = 100
 
 DEFAULT_QUERY = '''
@@ -72,13 +95,16 @@ _index=sumologic_volume
 
 QUERY_EXT = '.sqy'
 
+OUTPUTBASE = '/var/tmp'
+CACHE = os.path.join( OUTPUTBASE, 'run_report.cache' )
+
 CSV_SEP = ','
 TAB_SEP = '\t'
 EOL_SEP = '\n'
 
 MY_SEP = CSV_SEP
 if ARGS.OUT_FORMAT == 'txt':
-    MS_SEP = TAB_SEP
+    MY_SEP = TAB_SEP
 
 NOW_TIME = int(time.time()) * SEC_M
 
@@ -118,9 +144,11 @@ def main():
     Once done, then issue the command required
     """
 
-    source = SumoApiClient(SUMO_UID, SUMO_KEY)
+    source = SumoApiClient(SUMO_UID, SUMO_KEY, os.environ.get('SUMO_END'))
 
     time_params = calculate_range()
+    if RESULT_CACHE is not None:
+        time_params = align_range(time_params, parse_period(ARGS.CACHE_ALIGN))
 
     counter = 1
 
@@ -131,15 +159,30 @@ def main():
         if ARGS.VERBOSE > 4:
             print(f'RUN_QUERY.query_item: {query_item}')
             print(f'RUN_QUERY.query_data: {query_data}')
-        header_output = run_sumo_query(source, query_data, time_params)
-        if ARGS.VERBOSE > 8:
-            print(f'RUN_QUERY.output: {header_output}')
-        write_query_output(header_output, counter)
+        output_target = build_output_target(counter)
         counter += 1
 
-def write_query_output(header_output, query_number):
+        cache_key = None
+        if RESULT_CACHE is not None:
+            cache_key = RESULT_CACHE.build_key('run_report', query_data, QUERY_TAG, \
+                                               time_params, ARGS.OUT_FORMAT)
+            if not ARGS.CACHE_BYPASS and RESULT_CACHE.restore(cache_key, output_target):
+                if ARGS.VERBOSE > 3:
+                    print(f'RUN_QUERY.cached: {output_target}')
+                continue
+
+        run_sumo_query(source, query_data, time_params, output_target)
+
+        if cache_key is not None:
+            RESULT_CACHE.store(cache_key, output_target, target=QUERY_TAG, query=query_item)
+
+    if ARGS.VERBOSE > 2:
+        print(f'RUN_QUERY.retries: {source.metrics["retries"]} ' + \
+              f'wait: {source.metrics["retry_wait"]:.1f}s')
+
+def build_output_target(query_number):
     """
-    This is a wrapper for writing out the contents of a file
+    This builds the name of the output file for a query number
     """
 
     ext_sep = '.'
@@ -148,18 +191,39 @@ def write_query_output(header_output, query_number):
     extension = ARGS.OUT_FORMAT
     number = f'{query_number:03d}'
 
-    output_dir = '/var/tmp'
+    output_dir = OUTPUTBASE
     output_file = ext_sep.join((querytag, str(number), extension))
     output_target = os.path.join(output_dir, output_file)
 
-    if ARGS.VERBOSE > 2:
-        print(header_output)
-
     if ARGS.VERBOSE > 3:
         print(output_target)
 
+    return output_target
+
+def write_query_output(output_target, query_pages):
+    """
+    This streams the query output to a file one page at a time.
+    The header is written once from the first page, and each page is flushed
+    as soon as it is serialized rather than held until the query completes.
+    """
+
+    serializer = None
     with open(output_target, "w", encoding='utf8') as file_object:
-        file_object.write(header_output + '\n' )
+        for query_records in query_pages:
+            if serializer is None:
+                serializer = RecordSerializer(query_records["fields"], MY_SEP)
+                header = serializer.header()
+                file_object.write(header)
+                if ARGS.VERBOSE > 2:
+                    print(header, end='')
+            output = serializer.page(query_records)
+            if output:
+                file_object.write(output)
+                if ARGS.VERBOSE > 2:
+                    print(output, end='')
+            file_object.flush()
+        if serializer is None:
+            file_object.write(EOL_SEP)
 
 def tailor_queries(query_item):
     """
@@ -196,6 +260,25 @@ def calculate_range():
     TIME_PARAMS["by_receipt_time"] = False
     return TIME_PARAMS
 
+def parse_period(period_marker):
+    """
+    This turns a period such as 15m or 1d into milliseconds
+    """
+    period_number = re.match(r'\d+', period_marker.replace('-', ''))
+    period_unit = period_marker.replace('-', '').replace(period_number.group(), '')
+    return int(period_number.group()) * int(TIME_TABLE[period_unit])
+
+def align_range(time_params, boundary):
+    """
+    This snaps the range back to a boundary, keeping its length, so runs a
+    little apart ask the same question and can share cached outputs
+    """
+    aligned_params = dict(time_params)
+    shift = time_params["time_to"] % boundary
+    aligned_params["time_to"] = time_params["time_to"] - shift
+    aligned_params["time_from"] = time_params["time_from"] - shift
+    return aligned_params
+
 def collect_queries():
     """
     Scoop up a query if a directory, file or a string
@@ -228,7 +311,7 @@ def collect_contents(query_item):
             query = file_object.read()
     return query
 
-def run_sumo_query(source, query, time_params):
+def run_sumo_query(source, query, time_params, output_target):
     """
     This runs the Sumo Command, and then saves the output and the status
     """
@@ -246,37 +329,18 @@ def run_sumo_query(source, query, time_params):
         print(f'RUN_QUERY.records: {num_records}')
         print(f'RUN_QUERY.iterations: {iterations}')
 
-    header_list = []
-    record_body_list = []
+    query_pages = fetch_record_pages(source, query_jobid, num_records)
+    write_query_output(output_target, query_pages)
 
-    for my_counter in range(0, iterations, 1):
-        my_limit = LIMIT
-        my_offset = ( my_limit * my_counter )
+    return query_jobid
 
-        query_records = source.search_job_records(query_jobid, my_limit, my_offset)
-
-        if my_counter == 0:
-            fields = query_records["fields"]
-            for field in fields:
-                fieldname = field["name"]
-                header_list.append(fieldname)
-
-        records = query_records["records"]
-        for record in records:
-            record_line_list = []
-            for field in fields:
-                fieldname = field["name"]
-                recordname = str(record["map"][fieldname])
-                record_line_list.append(recordname)
-                record_line = MY_SEP.join(record_line_list)
-            record_body_list.append(record_line)
-
-    header = MY_SEP.join(header_list)
-
-    output = EOL_SEP.join(record_body_list)
-    header_output = EOL_SEP.join((header, output))
-
-    return header_output
+def fetch_record_pages(source, query_jobid, num_records):
+    """
+    This hands back the record pages of a finished job one page at a time.
+    The first page is fetched even for a job with no records, for its fields.
+    """
+    for my_offset in range(0, max(num_records, 1), LIMIT):
+        yield source.search_job_records(query_jobid, LIMIT, my_offset)
 
 ### class ###
 class SumoApiClient():
@@ -290,12 +354,7 @@ class SumoApiClient():
         Initializes the Sumo Logic object
         """
 
-        self.retry_strategy = Retry(
-            total=10,
-            status_forcelist=[429, 500, 502, 503, 504],
-            allowed_methods=["HEAD", "GET", "OPTIONS"]
-        )
-        self.adapter = HTTPAdapter(max_retries=self.retry_strategy)
+        self.adapter = HTTPAdapter()
 
         self.session = requests.Session()
 
@@ -305,6 +364,9 @@ class SumoApiClient():
         self.session.auth = (access_id, access_key)
         self.session.headers = {'content-type': 'application/json', \
             'accept': 'application/json'}
+        self.limiter = RateLimiter(access_id, ARGS.API_RATE, ARGS.API_BURST)
+        self.metrics = collections.Counter()
+        self.metrics_lock = threading.Lock()
         cookiejar = http.cookiejar.FileCookieJar(cookie_file)
         self.session.cookies = cookiejar
         if endpoint is None:
@@ -322,53 +384,69 @@ class SumoApiClient():
         It contacts the default REST endpoint and resolves the 401 to get the right endpoint.
         """
         self.endpoint = 'https://api.sumologic.com/api'
+        self.limiter.acquire()
         self.response = self.session.get('https://api.sumologic.com/api/v1/collectors')
         endpoint = self.response.url.replace('/v1/collectors', '')
         return endpoint
 
-    def delete(self, method, params=None, headers=None, data=None):
+    def _request(self, verb, method, **kwargs):
         """
-        Defines a Sumo Logic Delete operation
+        Sends a request through the rate limiter, retrying throttled and failed
+        ones. Job creation is only sent again if it never reached the server,
+        otherwise the error is raised and any job it started times out unused.
+        Each retry and its wait are counted in the client metrics.
         """
-        response = self.session.delete(self.endpoint + method, \
-            params=params, headers=headers, data=data)
+        backoff = RetryBackoff()
+        while True:
+            self.limiter.acquire()
+            request_error = None
+            try:
+                response = self.session.request(verb, self.endpoint + method, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+                (response, request_error) = (None, error)
+            if request_error is not None and not retry_safe(verb, request_error):
+                raise request_error
+            if response is not None and response.status_code not in RETRY_STATUS:
+                break
+            wait = backoff.wait(response)
+            if wait is None:
+                if request_error is not None:
+                    raise request_error
+                break
+            with self.metrics_lock:
+                self.metrics['retries'] += 1
+                self.metrics['retry_wait'] += wait
+            time.sleep(wait)
         if response.status_code != 200:
             response.reason = response.text
         response.raise_for_status()
         return response
 
+    def delete(self, method, params=None, headers=None, data=None):
+        """
+        Defines a Sumo Logic Delete operation
+        """
+        return self._request('DELETE', method, params=params, headers=headers, data=data)
+
     def get(self, method, params=None, headers=None):
         """
         Defines a Sumo Logic Get operation
         """
-        response = self.session.get(self.endpoint + method, \
-            params=params, headers=headers)
-        if response.status_code != 200:
-            response.reason = response.text
-        response.raise_for_status()
-        return response
+        return self._request('GET', method, params=params, headers=headers)
 
     def post(self, method, data, headers=None, params=None):
         """
         Defines a Sumo Logic Post operation
         """
-        response = self.session.post(self.endpoint + method, \
-            data=json.dumps(data), headers=headers, params=params)
-        if response.status_code != 200:
-            response.reason = response.text
-        response.raise_for_status()
-        return response
+        return self._request('POST', method, data=json.dumps(data), headers=headers, \
+                             params=params)
 
     def put(self, method, data, headers=None, params=None):
         """
         Defines a Sumo Logic Put operation
         """
-        response = self.session.put(self.endpoint + method, \
-            data=json.dumps(data), headers=headers, params=params)
-        if response.status_code != 200:
-            response.reason = response.text
-        response.raise_for_status()
-        return response
+        return self._request('PUT', method, data=json.dumps(data), headers=headers, \
+                             params=params)
 
 ### class ###
 ### methods ###
@@ -410,7 +488,7 @@ class SumoApiClient():
         num_records = query_output['recordCount']
         time.sleep(1)
         iterations = 1
-        while query_status == 'GATHERING RESULTS':
+        while query_status in POLL_STATES:
             query_output = self.search_job_status(query_jobid)
             query_status = query_output['state']
             num_records = query_output['recordCount']
@@ -424,7 +502,6 @@ class SumoApiClient():
         Calculate and return records in chunks based on LIMIT
         """
         job_records = []
-        time.sleep(1)
         iterations = num_records // LIMIT + 1
         for iteration in range(1, iterations + 1):
             records = self.search_job_records(query_jobid, limit=LIMIT,
@@ -443,7 +520,7 @@ class SumoApiClient():
         num_messages = query_output['messageCount']
         time.sleep(1)
         iterations = 1
-        while query_status == 'GATHERING RESULTS':
+        while query_status in POLL_STATES:
             query_output = self.search_job_status(query_jobid)
             query_status = query_output['state']
             num_messages = query_output['messageCount']
@@ -456,7 +533,6 @@ class SumoApiClient():
         Calculate and return messages in chunks based on LIMIT
         """
         job_messages = []
-        time.sleep(1)
         iterations = num_messages // LIMIT + 1
         for iteration in range(1, iterations + 1):
             records = self.search_job_records(query_jobid, limit=LIMIT,
@@ -469,7 +545,6 @@ class SumoApiClient():
         """
         Query the job messages of a search job
         """
-        time.sleep(1)
         params = {'limit': limit, 'offset': offset}
         response = self.get('/v1/search/jobs/' + str(query_jobid) + '/messages', params)
         return json.loads(response.text)
@@ -478,7 +553,6 @@ class SumoApiClient():
         """
         Query the job records of a search job
         """
-        time.sleep(1)
         params = {'limit': limit, 'offset': offset}
         response = self.get('/v1/search/jobs/' + str(query_jobid) + '/records', params)
         return json.loads(response.text)
@@ -491,5 +565,10 @@ class SumoApiClient():
 
 ### methods ###
 
+RESULT_CACHE = None
+if ARGS.CACHE_TTL:
+    RESULT_CACHE = ResultCache(CACHE, parse_period(ARGS.CACHE_TTL) / SEC_M, \
+                               ARGS.CACHE_SIZE * 1024 * 1024)
+
 if __name__ == '__main__':
     main()
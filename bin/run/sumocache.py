@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Exaplanation: sumocache is an on disk cache of query outputs shared by the run cmdlets
+
+Usage:
+   from sumocache import ResultCache
+
+Style:
+   Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+    @name           sumocache
+    @version        1.00
+    @author-name    Wayne Schmidt
+    @author-email   wschmidt@sumologic.com
+    @license-name   Apache 2.0
+    @license-url    http://www.gnu.org/licenses/gpl.html
+"""
+
+__version__ = 1.00
+__author__ = "Wayne Schmidt (wschmidt@sumologic.com)"
+
+### beginning ###
+import json
+import os
+import hashlib
+import shutil
+import threading
+import time
+
+DATA_EXT = '.out'
+META_EXT = '.json'
+
+### beginning ###
+
+### class ###
+class ResultCache():
+    """
+    This is a content addressed cache of query outputs kept on disk.
+    Entries expire after a time to live, and the least recently used entries
+    are evicted once the cache grows past its size limit.
+    """
+
+    def __init__(self, cache_dir, ttl, max_size):
+        """
+        Initializes the cache directory, the time to live in seconds,
+        and the size limit in bytes
+        """
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def build_key(*key_parts):
+        """
+        Hash everything that decides the contents of an output into a key
+        """
+        key_text = json.dumps(key_parts, sort_keys=True, default=str)
+        return hashlib.sha256(key_text.encode('utf8')).hexdigest()
+
+    def _path(self, cache_key, extension):
+        """
+        Locate the data or the metadata file of an entry
+        """
+        return os.path.join(self.cache_dir, cache_key + extension)
+
+    def restore(self, cache_key, output_target):
+        """
+        Copy a live entry out to the output file, and mark it as recently used.
+        Returns False when there is no entry or it has expired.
+        """
+        try:
+            with open(self._path(cache_key, META_EXT), "r", encoding='utf8') as file_object:
+                cache_meta = json.load(file_object)
+        except (OSError, ValueError):
+            return False
+
+        if time.time() - cache_meta.get('created', 0) > self.ttl:
+            self._remove(cache_key)
+            return False
+
+        scratch = output_target + '.cache'
+        try:
+            shutil.copyfile(self._path(cache_key, DATA_EXT), scratch)
+            os.replace(scratch, output_target)
+            os.utime(self._path(cache_key, DATA_EXT))
+        except OSError:
+            return False
+        return True
+
+    def store(self, cache_key, output_target, **cache_meta):
+        """
+        Copy a finished output into the cache, then evict to stay under the limit
+        """
+        scratch = self._path(cache_key, DATA_EXT) + '.' + str(threading.get_ident())
+        shutil.copyfile(output_target, scratch)
+        os.replace(scratch, self._path(cache_key, DATA_EXT))
+
+        cache_meta['created'] = time.time()
+        scratch = self._path(cache_key, META_EXT) + '.' + str(threading.get_ident())
+        with open(scratch, "w", encoding='utf8') as file_object:
+            file_object.write(json.dumps(cache_meta, default=str))
+        os.replace(scratch, self._path(cache_key, META_EXT))
+
+        self.evict()
+
+    def evict(self):
+        """
+        Drop expired entries, then the least recently used ones until the
+        cache fits within its size limit
+        """
+        with self.lock:
+            cache_entries = []
+            for cache_file in os.listdir(self.cache_dir):
+                if not cache_file.endswith(DATA_EXT):
+                    continue
+                cache_key = cache_file[:-len(DATA_EXT)]
+                try:
+                    cache_stat = os.stat(self._path(cache_key, DATA_EXT))
+                    created = os.stat(self._path(cache_key, META_EXT)).st_mtime
+                except OSError:
+                    self._remove(cache_key)
+                    continue
+                if time.time() - created > self.ttl:
+                    self._remove(cache_key)
+                    continue
+                cache_entries.append((cache_stat.st_mtime, cache_stat.st_size, cache_key))
+
+            cache_size = sum(entry_size for _used, entry_size, _key in cache_entries)
+            for _used, entry_size, cache_key in sorted(cache_entries):
+                if cache_size <= self.max_size:
+                    break
+                self._remove(cache_key)
+                cache_size -= entry_size
+
+    def _remove(self, cache_key):
+        """
+        Delete both files of an entry, ignoring ones already gone
+        """
+        for extension in (DATA_EXT, META_EXT):
+            try:
+                os.remove(self._path(cache_key, extension))
+            except FileNotFoundError:
+                pass
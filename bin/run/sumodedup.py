@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Exaplanation: sumodedup is a bounded on disk index of the records a cmdlet has already sent
+
+Usage:
+   from sumodedup import DedupIndex
+
+Style:
+   Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+    @name           sumodedup
+    @version        1.00
+    @author-name    Wayne Schmidt
+    @author-email   wschmidt@sumologic.com
+    @license-name   Apache 2.0
+    @license-url    http://www.gnu.org/licenses/gpl.html
+"""
+
+__version__ = 1.00
+__author__ = "Wayne Schmidt (wschmidt@sumologic.com)"
+
+### beginning ###
+import collections
+import hashlib
+import json
+import os
+import threading
+
+DIGEST_SIZE = 16
+
+### beginning ###
+
+### class ###
+class DedupIndex():
+    """
+    This remembers the records already sent by a digest of their identity.
+    Digests added during a run stay pending until commit() is given those
+    whose records are known to be posted, the others are forgotten, as they
+    are by rollback(). Past max_entries the least recently seen digests are
+    dropped, so the index stays bounded.
+    The index is one file of digests, oldest first, replaced in one step.
+    """
+
+    def __init__(self, index_file, max_entries):
+        """
+        Initializes the index file and its size limit, loading what earlier runs left
+        """
+        self.index_file = index_file
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.seen = collections.OrderedDict()
+        self.pending = collections.OrderedDict()
+        self.load()
+
+    @staticmethod
+    def build_key(*key_parts):
+        """
+        Hash everything that makes up the identity of a record into a digest
+        """
+        key_text = json.dumps(key_parts, sort_keys=True, default=str)
+        return hashlib.blake2b(key_text.encode('utf8'), digest_size=DIGEST_SIZE).digest()
+
+    def load(self):
+        """
+        Read the digests an earlier run saved, a missing file reads as none
+        """
+        try:
+            with open(self.index_file, "rb") as file_object:
+                index_data = file_object.read()
+        except OSError:
+            return
+        usable = len(index_data) - len(index_data) % DIGEST_SIZE
+        for offset in range(max(0, usable - self.max_entries * DIGEST_SIZE), usable, DIGEST_SIZE):
+            self.seen[index_data[offset:offset + DIGEST_SIZE]] = None
+
+    def add(self, digest):
+        """
+        Add a digest, returning False when it was seen before
+        """
+        with self.lock:
+            if digest in self.seen:
+                self.seen.move_to_end(digest)
+                return False
+            if digest in self.pending:
+                return False
+            self.pending[digest] = None
+            return True
+
+    def commit(self, digests=None):
+        """
+        Keep the pending digests that were posted, all of them when none are given,
+        forget the rest, drop the least recently seen past the limit, and save
+        """
+        with self.lock:
+            if digests is None:
+                digests = list(self.pending)
+            for digest in digests:
+                if digest in self.pending:
+                    self.seen[digest] = None
+            self.pending.clear()
+            while len(self.seen) > self.max_entries:
+                self.seen.popitem(last=False)
+            scratch = self.index_file + '.' + str(os.getpid())
+            with open(scratch, "wb") as file_object:
+                file_object.write(b''.join(self.seen))
+            os.replace(scratch, self.index_file)
+
+    def rollback(self):
+        """
+        Forget the pending digests, their records may not have been posted
+        """
+        with self.lock:
+            self.pending.clear()
+
+    def __len__(self):
+        """
+        The number of digests kept
+        """
+        with self.lock:
+            return len(self.seen) + len(self.pending)
+
+### class ###
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Exaplanation: sumolimit paces Sumo Logic API calls to a rate shared by every cmdlet on a host,
+and works out how long to back off before retrying a throttled or failed call
+
+Usage:
+   from sumolimit import RateLimiter, RetryBackoff, RETRY_STATUS, retry_safe
+
+Style:
+   Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+    @name           sumolimit
+    @version        1.00
+    @author-name    Wayne Schmidt
+    @author-email   wschmidt@sumologic.com
+    @license-name   Apache 2.0
+    @license-url    http://www.gnu.org/licenses/gpl.html
+"""
+
+__version__ = 1.00
+__author__ = "Wayne Schmidt (wschmidt@sumologic.com)"
+
+### beginning ###
+import email.utils
+import hashlib
+import os
+import random
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+STATE_PREFIX = 'sumolimit.'
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+RETRY_ATTEMPTS = 8
+RETRY_BASE = 0.5
+RETRY_CAP = 60
+RETRY_AFTER_CAP = 300
+
+### beginning ###
+
+### class ###
+class RateLimiter():
+    """
+    This is a token bucket keyed by access id. The bucket lives in a small
+    state file locked with flock, so every thread and every process using the
+    same access id on a host draws from one bucket. Each call takes a token,
+    letting the level go below zero, and sleeps off its share of the debt, so
+    callers are paced at exactly the rate and served in the order they asked.
+    Without fcntl the bucket is only shared by the threads of one process.
+    """
+
+    def __init__(self, access_id, rate, burst=None, state_dir=None):
+        """
+        Initializes the bucket of an access id with its rate per second and its burst
+        """
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, self.rate))
+        key = hashlib.sha256(access_id.encode('utf8')).hexdigest()[:16]
+        self.state_file = os.path.join(state_dir or tempfile.gettempdir(), STATE_PREFIX + key)
+        self.lock = threading.Lock()
+        self.state = None
+
+    def acquire(self, tokens=1):
+        """
+        Take tokens from the bucket, sleeping until they are covered.
+        Returns the seconds spent waiting.
+        """
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            if fcntl is None:
+                wait = self._take(tokens)
+            else:
+                wait = self._take_shared(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def _take(self, tokens):
+        """
+        Refill the bucket for the time gone by, take the tokens, and work out
+        how long the caller has to wait
+        """
+        now = time.time()
+        (level, stamp) = self.state or (self.burst, now)
+        level = min(self.burst, level + max(0, now - stamp) * self.rate) - tokens
+        self.state = (level, now)
+        return max(0, -level / self.rate)
+
+    def _take_shared(self, tokens):
+        """
+        Take tokens from the bucket in the state file, holding its lock
+        """
+        with open(self.state_file, "a+", encoding='utf8') as file_object:
+            fcntl.flock(file_object, fcntl.LOCK_EX)
+            try:
+                file_object.seek(0)
+                try:
+                    (level, stamp) = (float(value) for value in file_object.read().split())
+                    self.state = (level, stamp)
+                except ValueError:
+                    self.state = None
+                wait = self._take(tokens)
+                file_object.seek(0)
+                file_object.truncate()
+                file_object.write(f'{self.state[0]} {self.state[1]}')
+                file_object.flush()
+            finally:
+                fcntl.flock(file_object, fcntl.LOCK_UN)
+        return wait
+
+class RetryBackoff():
+    """
+    This works out the waits between the attempts of one call. The server's
+    Retry-After is honoured when it sends one, otherwise the wait follows
+    decorrelated jitter: a random wait between the base and three times the
+    last one, capped, so retrying callers spread out instead of retrying together.
+    """
+
+    def __init__(self, attempts=RETRY_ATTEMPTS, base=RETRY_BASE, cap=RETRY_CAP):
+        """
+        Initializes the number of retries allowed and the bounds of the wait
+        """
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+        self.previous = base
+
+    def wait(self, response=None):
+        """
+        Returns the seconds to wait before the next attempt, or None once the
+        retries have run out
+        """
+        self.attempt += 1
+        if self.attempt > self.attempts:
+            return None
+        self.previous = min(self.cap, random.uniform(self.base, self.previous * 3))
+        hint = retry_after(response)
+        return self.previous if hint is None else hint
+
+### class ###
+
+def retry_safe(verb, request_error):
+    """
+    Whether a call that failed without an answer can be sent again. Anything but
+    a POST can. A POST only can when the connection was never made, so the
+    server never saw it: one cut off after it was sent may have created a search
+    job whose id never came back, and sending it again would start another.
+    """
+    if verb != 'POST':
+        return True
+    import urllib3
+    reason = getattr(request_error.args[0], 'reason', None) if request_error.args else None
+    return isinstance(reason, urllib3.exceptions.ConnectTimeoutError)
+
+def retry_after(response):
+    """
+    Read the Retry-After of a response, in seconds or as a date, None without one
+    """
+    if response is None or not response.headers.get('Retry-After'):
+        return None
+    hint = response.headers['Retry-After'].strip()
+    try:
+        seconds = float(hint)
+    except ValueError:
+        try:
+            seconds = email.utils.parsedate_to_datetime(hint).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(RETRY_AFTER_CAP, max(0, seconds))
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Exaplanation: sumometrics times the phases of a run and counts its api calls, by target and query
+
+Usage:
+   from sumometrics import RunMetrics
+
+Style:
+   Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+    @name           sumometrics
+    @version        1.00
+    @author-name    Wayne Schmidt
+    @author-email   wschmidt@sumologic.com
+    @license-name   Apache 2.0
+    @license-url    http://www.gnu.org/licenses/gpl.html
+"""
+
+__version__ = 1.00
+__author__ = "Wayne Schmidt (wschmidt@sumologic.com)"
+
+### beginning ###
+import collections
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+PHASES = ('create', 'poll', 'page', 'serialize', 'write')
+
+SUMMARY_COLUMNS = (('wall_s', 'wall'), ('create_s', 'create'), ('poll_s', 'poll'), \
+                   ('page_s', 'page'), ('serialize_s', 'serialize'), ('write_s', 'write'), \
+                   ('requests', 'requests'), ('bytes_received', 'mb_in'), \
+                   ('retries', 'retries'), ('sleep_s', 'sleep'), ('records', 'records'))
+
+MB_B = 1024 * 1024
+
+CURRENT_QUERY = contextvars.ContextVar('sumometrics_query', default=None)
+
+### beginning ###
+
+### class ###
+class RunMetrics():
+    """
+    This collects the phase timings, api calls, bytes, retries and sleeps of a
+    run. Whatever happens inside scope() is counted against that target and
+    query; work handed to other threads keeps its query when the callable is
+    wrapped with bind(). Counts made outside any query go to the run alone.
+    Timings are seconds summed over the threads that spent them, so with
+    concurrent fetches a phase can add up to more than the wall time.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty run, started now
+        """
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.unscoped = collections.Counter()
+        self.queries = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def scope(self, query_target, query_number, query_item=None):
+        """
+        Count everything done inside against a target and query, and time it
+        """
+        query_key = (query_target, f'{query_number:03d}')
+        with self.lock:
+            query_entry = self.queries.setdefault(query_key, \
+                {'query': query_item, 'status': 'done', \
+                 'counters': collections.Counter({ phase + '_s': 0.0 for phase in PHASES })})
+        token = CURRENT_QUERY.set(query_entry)
+        start_time = time.perf_counter()
+        try:
+            yield query_entry
+        except BaseException as query_error:
+            query_entry['status'] = 'error'
+            query_entry['error'] = str(query_error)
+            raise
+        finally:
+            self.count('wall_s', time.perf_counter() - start_time)
+            CURRENT_QUERY.reset(token)
+
+    @staticmethod
+    def bind(function):
+        """
+        Wrap a callable so that it counts against the current query on any thread
+        """
+        return functools.partial(contextvars.copy_context().run, function)
+
+    @staticmethod
+    def note(**details):
+        """
+        Record details of the current query, such as its job id or status
+        """
+        query_entry = CURRENT_QUERY.get()
+        if query_entry is not None:
+            query_entry.update(details)
+
+    def count(self, name, amount=1):
+        """
+        Add to a counter of the current query, or of the run outside any query
+        """
+        query_entry = CURRENT_QUERY.get()
+        with self.lock:
+            if query_entry is None:
+                self.unscoped[name] += amount
+            else:
+                query_entry['counters'][name] += amount
+
+    def slept(self, reason, seconds):
+        """
+        Count a sleep, both under its reason and in the total slept
+        """
+        if seconds > 0:
+            self.count(reason + '_s', seconds)
+            self.count('sleep_s', seconds)
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        """
+        Time a phase
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.count(phase + '_s', time.perf_counter() - start_time)
+
+    def timed(self, iterable, phase):
+        """
+        Hand back the items of an iterable, timing each wait for the next one as a phase
+        """
+        iterator = iter(iterable)
+        while True:
+            start_time = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.count(phase + '_s', time.perf_counter() - start_time)
+                return
+            self.count(phase + '_s', time.perf_counter() - start_time)
+            yield item
+
+    def totals(self):
+        """
+        Add up the counters of every query and of the run itself
+        """
+        with self.lock:
+            run_counters = collections.Counter(self.unscoped)
+            for query_entry in self.queries.values():
+                run_counters.update(query_entry['counters'])
+        return run_counters
+
+    def report(self):
+        """
+        Build the run, per target and per query breakdown
+        """
+        targets = collections.OrderedDict()
+        with self.lock:
+            for (query_target, query_number), query_entry in self.queries.items():
+                target_entry = targets.setdefault(query_target, \
+                    {'counters': collections.Counter(), 'queries': collections.OrderedDict()})
+                target_entry['counters'].update(query_entry['counters'])
+                query_report = { key: value for key, value in query_entry.items() \
+                                 if key != 'counters' }
+                query_report.update(rounded(query_entry['counters']))
+                target_entry['queries'][query_number] = query_report
+
+        run_report = {'started': int(self.started), 'pid': os.getpid()}
+        run_report.update(rounded(self.totals()))
+        run_report['wall_s'] = round(time.time() - self.started, 3)
+        run_report['targets'] = collections.OrderedDict( \
+            (query_target, dict(rounded(target_entry['counters']), \
+                                queries=target_entry['queries'])) \
+            for query_target, target_entry in targets.items())
+        return run_report
+
+    def write(self, metrics_file):
+        """
+        Write the report to a json file, replacing it in one step
+        """
+        scratch = metrics_file + '.' + str(os.getpid())
+        with open(scratch, "w", encoding='utf8') as file_object:
+            json.dump(self.report(), file_object, indent=4)
+        os.replace(scratch, metrics_file)
+
+    def summary(self, file_object=sys.stderr):
+        """
+        Print a table of each query, each target and the run
+        """
+        run_report = self.report()
+        rows = []
+        for query_target, target_report in run_report['targets'].items():
+            for query_number, query_report in target_report['queries'].items():
+                rows.append((query_target, query_number, query_report))
+            rows.append((query_target, 'all', target_report))
+        rows.append(('run', 'all', run_report))
+
+        headers = ('target', 'query') + tuple(title for _name, title in SUMMARY_COLUMNS)
+        lines = [ headers ] + [ (query_target, query_number) + \
+                                tuple(format_value(name, report.get(name, 0)) \
+                                      for name, _title in SUMMARY_COLUMNS) \
+                                for query_target, query_number, report in rows ]
+        widths = [ max(len(line[column]) for line in lines) for column in range(len(headers)) ]
+        for line in lines:
+            print('  '.join(value.ljust(widths[column]) if column < 2 \
+                            else value.rjust(widths[column]) \
+                            for column, value in enumerate(line)), file=file_object)
+
+### class ###
+
+def rounded(counters):
+    """
+    Round the timings of a set of counters, leaving the counts alone
+    """
+    return { name: round(value, 3) if isinstance(value, float) else value \
+             for name, value in sorted(counters.items()) }
+
+def format_value(name, value):
+    """
+    Format a counter for the summary table
+    """
+    if name == 'bytes_received':
+        return f'{value / MB_B:.1f}'
+    if name.endswith('_s'):
+        return f'{value:.2f}'
+    return str(value)
@@ -24,6 +24,8 @@ __version__ = 1.40
 __author__ = "Wayne Schmidt (wschmidt@sumologic.com)"
 
 ### beginning ###
+import csv
+import gzip
 import json
 import os
 import sys
@@ -32,15 +34,21 @@ import http
 import re
 import time
 import random
-import multiprocessing
-import pathlib
+import collections
+import concurrent.futures
+import itertools
+import queue
+import threading
 import requests
 from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
-import pandas
-import boto3
+from sumocache import ResultCache
+from sumolimit import RateLimiter, RetryBackoff, RETRY_STATUS, retry_safe
+from sumometrics import RunMetrics
+from sumorecords import RecordSerializer, MessageSerializer
 
 sys.dont_write_bytecode = 1
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sumoprofile import start_profile
 
 MY_CFG = 'undefined'
 PARSER = argparse.ArgumentParser(description="""
@@ -50,25 +58,109 @@ run_query is a Sumo Logic cli cmdlet managing queries
 PARSER.add_argument("-a", metavar='<secret>', dest='MY_APIKEY', \
                     help="set query authkey (format: <key>:<secret>) ")
 PARSER.add_argument("-t", metavar='<targetorg>', dest='MY_TARGET', \
-                    required=True, action='append', \
+                    action='append', \
                     help="set query target  (format: <dep>_<orgid>) ")
 PARSER.add_argument("-q", metavar='<query>', dest='MY_QUERY', help="set query content")
 PARSER.add_argument("-r", metavar='<range>', dest='MY_RANGE', default='1h', \
                     help="set query range")
 PARSER.add_argument("-o", metavar='<fmt>', default="csv", dest='OUT_FORMAT', \
-                    help="set query output (values: txt, csv)")
+                    help="set query output (values: txt, csv, parquet, feather)")
 PARSER.add_argument("-d", metavar='<outdir>', default="/var/tmp/sumoquery", dest='OUTPUTDIR', \
                     help="set query output directory")
 PARSER.add_argument("-s", metavar='<sleeptime>', default=3, dest='SLEEPTIME', \
-                    help="set sleep time to check results")
+                    help="set maximum sleep time between checks for results")
 PARSER.add_argument("-w", metavar='<workers>', type=int, default=1, dest='WORKERS', \
-                    help="set number of workers to process")
+                    help="set number of queries to run at once across all targets")
+PARSER.add_argument("-j", metavar='<orgworkers>', type=int, default=1, dest='ORG_WORKERS', \
+                    help="set number of queries to run at once against one target")
+PARSER.add_argument("-f", metavar='<fetchers>', type=int, default=4, dest='FETCHERS', \
+                    help="set number of concurrent record page fetches per query")
 PARSER.add_argument("-v", type=int, default=0, metavar='<verbose>', \
                     dest='VERBOSE', help="increase verbosity")
 PARSER.add_argument("-p", default=False, action='store_true', \
-                    dest='CLEANUP', help="process remaining pending queries")
+                    dest='CLEANUP', help="resume remaining pending queries from their checkpoints")
+PARSER.add_argument("-b", metavar='<budget>', type=int, default=20, dest='JOB_BUDGET', \
+                    help="set number of active search jobs allowed per target")
+PARSER.add_argument("-B", metavar='<budget>', type=int, default=0, dest='TOTAL_BUDGET', \
+                    help="set number of active search jobs allowed in total (0 is no limit)")
+PARSER.add_argument("--fairness", metavar='<policy>', default='roundrobin', dest='FAIRNESS', \
+                    choices=['roundrobin', 'shortest'], \
+                    help="set order waiting search jobs start in (values: roundrobin, shortest)")
+PARSER.add_argument("-x", "--split", metavar='<splits>', type=int, default=1, dest='SPLITS', \
+                    help="split the query range into concurrent search jobs and merge them")
+PARSER.add_argument("-g", default=False, action='store_true', dest='PROGRESSIVE', \
+                    help="download complete record pages while the job is still gathering")
+PARSER.add_argument("--messages", default=False, action='store_true', dest='MESSAGES', \
+                    help="export the raw messages of non aggregate queries as ndjson")
+PARSER.add_argument("-z", "--compress", metavar='<codec>', dest='COMPRESS', \
+                    choices=['gzip', 'zstd'], help="compress the output (values: gzip, zstd)")
+PARSER.add_argument("--compress-thread", default=False, action='store_true', \
+                    dest='COMPRESS_THREAD', help="compress and write the output on its own thread")
+PARSER.add_argument("--roll-rows", metavar='<rows>', type=int, default=0, dest='ROLL_ROWS', \
+                    help="start a new output part after this many rows")
+PARSER.add_argument("--roll-size", metavar='<megabytes>', type=int, default=0, dest='ROLL_SIZE', \
+                    help="start a new output part once a part reaches this size")
+PARSER.add_argument("--cache-ttl", metavar='<range>', dest='CACHE_TTL', \
+                    help="reuse the output of an identical query for this long (e.g. 15m)")
+PARSER.add_argument("--cache-align", metavar='<range>', default='5m', dest='CACHE_ALIGN', \
+                    help="snap the query range to this boundary when caching")
+PARSER.add_argument("--cache-size", metavar='<megabytes>', type=int, default=1024, \
+                    dest='CACHE_SIZE', help="set the size the query cache is evicted down to")
+PARSER.add_argument("--cache-bypass", default=False, action='store_true', dest='CACHE_BYPASS', \
+                    help="run queries even when cached, refreshing the cache")
+PARSER.add_argument("--incremental", default=False, action='store_true', dest='INCREMENTAL', \
+                    help="query only what is new since the last run and merge it into the output")
+PARSER.add_argument("--overlap", metavar='<range>', default='0m', dest='OVERLAP', \
+                    help="set how far back past the last run incremental queries look again")
+PARSER.add_argument("--rate", metavar='<persecond>', type=float, default=4, dest='API_RATE', \
+                    help="set api calls per second shared by every run using this access id")
+PARSER.add_argument("--burst", metavar='<calls>', type=int, dest='API_BURST', \
+                    help="set api calls allowed at once before pacing (default: the rate)")
+PARSER.add_argument("--reap", default=False, action='store_true', dest='REAP', \
+                    help="cancel and delete search jobs left behind by earlier runs")
+PARSER.add_argument("--metrics", metavar='<file>', dest='METRICS_FILE', \
+                    help="set file the run metrics are written to (default: <outdir>/metrics/)")
+PARSER.add_argument("--summary", default=False, action='store_true', dest='SUMMARY', \
+                    help="print a table of the run metrics to stderr when done")
+PARSER.add_argument("--profile", metavar='<path>', dest='PROFILE', \
+                    help="profile the run into files named after path or use env var SUMO_PROFILE")
 
 ARGS = PARSER.parse_args()
+start_profile(ARGS.PROFILE)
+
+if not ARGS.MY_TARGET and not ARGS.REAP:
+    PARSER.error('the following arguments are required: -t')
+
+COLUMNAR_FORMATS = ('parquet', 'feather')
+
+if ARGS.MESSAGES and (ARGS.OUT_FORMAT in COLUMNAR_FORMATS or ARGS.INCREMENTAL):
+    PARSER.error('--messages writes ndjson, drop -o parquet/feather and --incremental')
+
+if ARGS.OUT_FORMAT in COLUMNAR_FORMATS:
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        PARSER.error(f'-o {ARGS.OUT_FORMAT} needs the pyarrow module installed')
+    if ARGS.INCREMENTAL:
+        PARSER.error(f'--incremental merges csv or txt outputs, not {ARGS.OUT_FORMAT}')
+    if ARGS.ROLL_ROWS or ARGS.ROLL_SIZE:
+        PARSER.error(f'--roll-rows and --roll-size split csv or txt outputs, not {ARGS.OUT_FORMAT}')
+    if ARGS.OUT_FORMAT == 'feather' and ARGS.COMPRESS == 'gzip':
+        PARSER.error('feather outputs compress with zstd, not gzip')
+elif ARGS.COMPRESS == 'zstd':
+    try:
+        import zstandard
+    except ImportError:
+        PARSER.error('-z zstd needs the zstandard module installed')
+
+ROLLING = bool(ARGS.ROLL_ROWS or ARGS.ROLL_SIZE)
+
+if ARGS.INCREMENTAL and (ARGS.COMPRESS or ROLLING):
+    PARSER.error('--incremental merges plain single file outputs, drop -z and --roll-*')
+if ARGS.CACHE_TTL and ROLLING:
+    PARSER.error('--cache-ttl caches single file outputs, drop --roll-*')
 
 OUTPUTBASE = ARGS.OUTPUTDIR
 os.makedirs(OUTPUTBASE, exist_ok=True)
@@ -79,6 +171,17 @@ os.makedirs(PENDING, exist_ok=True)
 OUTPUTS = os.path.join( OUTPUTBASE, 'outputs' )
 os.makedirs(OUTPUTS, exist_ok=True)
 
+JOBS = os.path.join( OUTPUTBASE, 'jobs' )
+os.makedirs(JOBS, exist_ok=True)
+
+CACHE = os.path.join( OUTPUTBASE, 'cache' )
+
+WATERMARKS = os.path.join( OUTPUTBASE, 'watermarks' )
+os.makedirs(WATERMARKS, exist_ok=True)
+
+METRICS = os.path.join( OUTPUTBASE, 'metrics' )
+os.makedirs(METRICS, exist_ok=True)
+
 SEC_M = 1000
 MIN_S = 60
 HOUR_M = 60
@@ -88,6 +191,27 @@ WEEK_D = 7
 LIMIT = 10000
 LONGQUERY_LIMIT = 100
 
+POLL_MIN = 0.5
+POLL_STATES = ('NOT STARTED', 'GATHERING RESULTS', 'GATHERING RESULTS FROM SUBQUERIES')
+
+AGGREGATE_OPERATORS = ('count', 'count_distinct', 'count_frequent', 'sum', 'min', 'max', \
+                       'avg', 'pct', 'stddev', 'first', 'last', 'most_recent', 'least_recent')
+ADDITIVE_OPERATORS = {'count': '_count', 'sum': '_sum', 'min': '_min', 'max': '_max'}
+SPLIT_SORT_OPERATORS = ('sort', 'order')
+SPLIT_UNSAFE_OPERATORS = ('limit', 'head', 'tail', 'top', 'total', 'accum', 'sort', 'order')
+
+OUTPUT_EXT = 'ndjson' if ARGS.MESSAGES else ARGS.OUT_FORMAT
+RESULT_KEY = 'messages' if ARGS.MESSAGES else 'records'
+RESULT_COUNT = 'messageCount' if ARGS.MESSAGES else 'recordCount'
+
+COMPRESS_EXT = {'gzip': 'gz', 'zstd': 'zst'}
+COMPRESS_QUEUE = 4
+
+ARROW_TYPES = {'long': 'int64', 'int': 'int64', 'double': 'float64', 'boolean': 'bool'}
+
+TIMESLICE_COLUMN = '_timeslice'
+TIMESLICE_PATTERN = re.compile(r'\btimeslice\s+(?:by\s+)?(\d+[smhdw])\b', re.IGNORECASE)
+
 DEFAULT_QUERY = '''
 _index=sumologic_volume
 | count by _sourceCategory
@@ -103,9 +227,12 @@ EOL_SEP = '\n'
 
 MY_SLEEP = int(ARGS.SLEEPTIME)
 
+CHECKPOINT_LOCK = threading.Lock()
+WATERMARK_LOCK = threading.Lock()
+
 MY_SEP = CSV_SEP
 if ARGS.OUT_FORMAT == 'txt':
-    MS_SEP = TAB_SEP
+    MY_SEP = TAB_SEP
 
 NOW_TIME = int(time.time()) * SEC_M
 
@@ -129,6 +256,7 @@ if ARGS.MY_APIKEY:
             print(f'REGION: {REGION}')
             print(f'TOKENS: {TOKENS}')
 
+        import boto3
         ssmobject = boto3.client(METHOD, region_name=REGION)
         ssmresponse = ssmobject.get_parameters(
             Names=[ TOKENS ],
@@ -157,82 +285,423 @@ def main():
     Once done, then issue the command required
     """
 
-    apisession = SumoApiClient(SUMO_UID, SUMO_KEY)
+    apisession = SumoApiClient(SUMO_UID, SUMO_KEY, os.environ.get('SUMO_END'))
+
+    if ARGS.REAP:
+        reap_search_jobs(apisession)
+        if not ARGS.MY_TARGET:
+            return
 
     if ARGS.CLEANUP:
-        query_targets = os.listdir(PENDING)
+        query_targets = [ query_target for query_target in sorted(os.listdir(PENDING)) \
+                          if not query_target.startswith('.') ]
     else:
         query_targets = resolve_targets(TARGETS)
 
     query_list = collect_queries()
     time_params = calculate_range()
+    if RESULT_CACHE is not None:
+        time_params = align_range(time_params, parse_period(ARGS.CACHE_ALIGN))
 
+    try:
+        failures = process_request(apisession, query_targets, query_list, time_params)
+    finally:
+        report_metrics()
 
-    if ARGS.WORKERS == 1:
-        process_request(apisession, query_targets, query_list, time_params)
-    else:
-        worker_manager(query_targets)
+    if failures:
+        print(f'SUMOQUERY.failed: {failures} jobs', file=sys.stderr)
+        sys.exit(1)
 
-def worker_task(inputs):
+def report_metrics():
     """
-    This is the worker task function
+    Write the metrics of the run to its json file, and print the summary table
     """
-    apisession = SumoApiClient(SUMO_UID, SUMO_KEY)
-    query_list = collect_queries()
-    time_params = calculate_range()
-    workerpid = multiprocessing.current_process()
-    if ARGS.VERBOSE > 5:
-        print(f'SUMOQUERY.worker: {workerpid}')
-        print(f'SUMOQUERY.worktarget: {inputs}')
+    metrics_file = ARGS.METRICS_FILE
+    if metrics_file is None:
+        run_stamp = time.strftime('%Y%m%d%H%M%S', time.localtime(RUN_METRICS.started))
+        metrics_file = os.path.join( METRICS, f'{QUERY_TAG}.{run_stamp}.{os.getpid()}.json' )
+    RUN_METRICS.write(metrics_file)
+    if ARGS.VERBOSE > 3:
+        print(f'SUMOQUERY.metrics: {metrics_file}')
 
-    query_targets = []
-    query_targets.append(inputs)
+    if ARGS.SUMMARY:
+        RUN_METRICS.summary(sys.stderr)
 
-    process_request(apisession, query_targets, query_list, time_params)
+    if ARGS.VERBOSE > 2:
+        run_totals = RUN_METRICS.totals()
+        print(f'SUMOQUERY.retries: {run_totals["retries"]} ' + \
+              f'wait: {run_totals["retry_wait_s"]:.1f}s')
 
-def worker_manager(query_targets):
+def prepare_placeholders(query_targets, time_params):
     """
-    This is the manager function to handle mapping tasks to workers
+    Prepare the placeholder files. Each one holds the checkpoint of a target,
+    which -p reads back to pick up where an interrupted run stopped.
     """
-    worker_list = query_targets
-    with multiprocessing.Pool(ARGS.WORKERS) as task_queue:
-        task_queue.map(worker_task, worker_list)
 
-def prepare_placeholders(query_targets):
+    for query_target in query_targets:
+        placeholder = os.path.join( PENDING, query_target )
+        if ARGS.CLEANUP and os.path.exists(placeholder):
+            continue
+        write_checkpoint(query_target, {'time_params': time_params, 'queries': {}})
+
+def load_checkpoint(query_target):
+    """
+    Read the checkpoint of a target, an empty or missing one reads as empty
     """
-    Prepare the placeholder files
+    placeholder = os.path.join( PENDING, query_target )
+    try:
+        with open(placeholder, "r", encoding='utf8') as file_object:
+            checkpoint = json.load(file_object)
+    except (OSError, ValueError):
+        checkpoint = {}
+    checkpoint.setdefault('queries', {})
+    return checkpoint
+
+def write_checkpoint(query_target, checkpoint):
     """
+    Replace the checkpoint of a target in one step, so a crash never leaves
+    half of one behind
+    """
+    placeholder = os.path.join( PENDING, query_target )
+    scratch = os.path.join( PENDING, '.' + query_target + '.' + str(threading.get_ident()) )
+    with open(scratch, "w", encoding='utf8') as file_object:
+        file_object.write(json.dumps(checkpoint))
+    os.replace(scratch, placeholder)
 
-    for query_target in query_targets:
-        placeholder = os.path.join( PENDING, query_target )
-        pathlib.Path(placeholder).touch()
+def save_checkpoint(query_target, query_number, **query_state):
+    """
+    Update what the checkpoint of a target records about one of its queries:
+    the search job, its state, the records written so far and the output
+    """
+    with CHECKPOINT_LOCK:
+        checkpoint = load_checkpoint(query_target)
+        checkpoint['queries'].setdefault(str(query_number), {}).update(query_state)
+        write_checkpoint(query_target, checkpoint)
 
 def process_request(apisession, query_targets, query_list, time_params):
     """
-    perform the queries and process the output
+    perform the queries and process the output.
+    Every target and query pair is a job run on a pool of threads sharing one
+    pooled session, at most WORKERS at once and at most ORG_WORKERS per target.
+    Targets take turns, and a target's placeholder goes once all of its jobs pass.
+    Queries a checkpoint shows as done are not run again.
+    Every failed job is printed, and the number of failed jobs is returned.
     """
 
-    prepare_placeholders(query_targets)
+    prepare_placeholders(query_targets, time_params)
+
+    query_contents = [ (query_item, collect_contents(query_item)) for query_item in query_list ]
 
+    target_queues = collections.OrderedDict()
     for query_target in query_targets:
+        checkpoint = load_checkpoint(query_target)
+        target_params = checkpoint.get('time_params', time_params)
+        target_queues[query_target] = collections.deque( \
+            (query_target, querycounter, query_item, query_data, target_params) \
+            for querycounter, (query_item, query_data) in enumerate(query_contents, 1) \
+            if not checkpoint['queries'].get(str(querycounter), {}).get('done'))
+        if not target_queues[query_target]:
+            del target_queues[query_target]
+            os.remove(os.path.join( PENDING, query_target ))
+
+    target_remaining = { query_target: len(target_queues[query_target]) \
+                         for query_target in target_queues }
+    target_failed = set()
+    failures = 0
+    target_active = collections.Counter()
+    ready_targets = collections.deque(target_queues)
+    workers = max(1, ARGS.WORKERS)
+    org_workers = max(1, ARGS.ORG_WORKERS)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        while ready_targets or running:
+            while ready_targets and len(running) < workers:
+                query_target = ready_targets.popleft()
+                query_job = target_queues[query_target].popleft()
+                target_active[query_target] += 1
+                if target_queues[query_target] and target_active[query_target] < org_workers:
+                    ready_targets.append(query_target)
+                running[executor.submit(run_query_job, apisession, query_job)] = \
+                    (query_target, query_job[2])
+
+            done, _running = concurrent.futures.wait(running, \
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                (query_target, query_item) = running.pop(future)
+                if target_queues[query_target] and target_active[query_target] == org_workers:
+                    ready_targets.append(query_target)
+                target_active[query_target] -= 1
+                target_remaining[query_target] -= 1
+                if future.exception() is not None:
+                    target_failed.add(query_target)
+                    failures += 1
+                    print(f'SUMOQUERY.error: {query_target} {query_item} :: ' + \
+                          f'{future.exception()}')
+                if target_remaining[query_target] == 0 and query_target not in target_failed:
+                    os.remove(os.path.join( PENDING, query_target ))
+    return failures
+
+def run_query_job(apisession, query_job):
+    """
+    This runs a single target and query pair and writes out its output.
+    Everything it does is counted against the pair in the run metrics.
+    """
+    (query_target, querycounter, query_item, _query_data, _time_params) = query_job
+    with RUN_METRICS.scope(query_target, querycounter, query_item):
+        run_query_pair(apisession, query_job)
 
-        querycounter = 1
+def run_query_pair(apisession, query_job):
+    """
+    This works out the output of a target and query pair, from the cache or a search job
+    """
+    (query_target, querycounter, query_item, query_data, time_params) = query_job
+    query_data = tailor_queries(query_data, query_target)
+    if ARGS.VERBOSE > 7:
+        print(f'SUMOQUERY.query_item: {query_item}')
+        print(f'SUMOQUERY.query_data: {query_data}')
+    output_target = build_output_target(query_target, querycounter)
+    RUN_METRICS.note(output=output_target)
+
+    if ARGS.INCREMENTAL:
+        run_incremental_job(apisession, query_job, query_data, output_target)
+        return
+
+    cache_key = None
+    if RESULT_CACHE is not None:
+        cache_key = RESULT_CACHE.build_key(QUERY_TAG, query_data, query_target, \
+                                           time_params, OUTPUT_EXT, ARGS.COMPRESS)
+        if not ARGS.CACHE_BYPASS and RESULT_CACHE.restore(cache_key, output_target):
+            if ARGS.VERBOSE > 3:
+                print(f'SUMOQUERY.cached: {output_target}')
+            RUN_METRICS.note(status='cached')
+            save_checkpoint(query_target, querycounter, done=True)
+            return
+
+    run_sumo_query(apisession, query_data, time_params, output_target, \
+                   query_target, querycounter)
+    save_checkpoint(query_target, querycounter, done=True)
+
+    if cache_key is not None:
+        RESULT_CACHE.store(cache_key, output_target, target=query_target, query=query_item)
+
+def run_incremental_job(apisession, query_job, query_data, output_target):
+    """
+    This runs only the part of the range newer than the watermark the last run
+    of this target and query left, and merges that slice into the output.
+    The watermark moves on once the merged output is in place.
+    """
+    (query_target, querycounter, query_item, _query_data, time_params) = query_job
+    delta_params = calculate_delta_range(query_target, query_item, query_data, \
+                                         time_params, output_target)
+    if delta_params["time_from"] >= delta_params["time_to"]:
+        if ARGS.VERBOSE > 3:
+            print(f'SUMOQUERY.uptodate: {output_target}')
+        RUN_METRICS.note(status='uptodate')
+        save_checkpoint(query_target, querycounter, done=True)
+        return
+
+    delta_target = output_target + '.delta'
+    run_sumo_query(apisession, query_data, delta_params, delta_target, \
+                   query_target, querycounter)
+    with RUN_METRICS.timer('write'):
+        merge_incremental_output(output_target, delta_target)
+    save_watermark(query_target, query_item, time_to=delta_params["time_to"], \
+                   output=output_target)
+    save_checkpoint(query_target, querycounter, done=True)
+
+def load_watermarks(query_target):
+    """
+    Read the watermarks of a target, keyed by query, a missing file reads as none
+    """
+    watermark_file = os.path.join( WATERMARKS, query_target )
+    try:
+        with open(watermark_file, "r", encoding='utf8') as file_object:
+            return json.load(file_object)
+    except (OSError, ValueError):
+        return {}
+
+def save_watermark(query_target, query_item, **watermark):
+    """
+    Record how far a query has been run for a target, and the output it went to
+    """
+    watermark_file = os.path.join( WATERMARKS, query_target )
+    with WATERMARK_LOCK:
+        watermarks = load_watermarks(query_target)
+        watermarks[query_item] = watermark
+        scratch = os.path.join( WATERMARKS, '.' + query_target + '.' + str(threading.get_ident()) )
+        with open(scratch, "w", encoding='utf8') as file_object:
+            file_object.write(json.dumps(watermarks))
+        os.replace(scratch, watermark_file)
+
+def calculate_delta_range(query_target, query_item, query_data, time_params, output_target):
+    """
+    This narrows the range to start at the watermark, less the overlap, so late
+    arriving data is picked up again. The start is snapped back to the timeslice
+    of the query so every timeslice in the slice is complete. Without a
+    watermark, or an output to merge into, the whole range is run.
+    """
+    watermark = load_watermarks(query_target).get(query_item, {})
+    if watermark.get('output') != output_target or not os.path.exists(output_target):
+        return time_params
+
+    delta_params = dict(time_params)
+    delta_params["time_from"] = max(time_params["time_from"], \
+                                    watermark["time_to"] - parse_period(ARGS.OVERLAP))
+    timeslice = TIMESLICE_PATTERN.search(query_data)
+    if timeslice:
+        delta_params["time_from"] -= delta_params["time_from"] % parse_period(timeslice.group(1))
+    return delta_params
+
+def merge_incremental_output(output_target, delta_target):
+    """
+    This folds a newly queried slice into the output of earlier runs.
+    Rows are keyed by timeslice: timeslices the slice covers again replace the
+    old rows, and new ones are added. Outputs without a timeslice column have
+    the new rows appended, and a changed header starts the output over.
+    """
+    delta_header = read_output_header(delta_target)
+    output_header = read_output_header(output_target)
+
+    if delta_header == ['NORECORDS'] and output_header is not None:
+        os.remove(delta_target)
+        return
+    if output_header in (None, ['NORECORDS']) or output_header != delta_header:
+        os.replace(delta_target, output_target)
+        return
+
+    replaced = set()
+    if TIMESLICE_COLUMN in delta_header:
+        slice_index = delta_header.index(TIMESLICE_COLUMN)
+        with open(delta_target, "r", newline='', encoding='utf8') as delta_object:
+            replaced = { row[slice_index] for row in itertools.islice( \
+                         csv.reader(delta_object, delimiter=MY_SEP), 1, None) }
+
+    scratch = output_target + '.merge'
+    with open(scratch, "w", newline='', encoding='utf8') as file_object:
+        writer = csv.writer(file_object, delimiter=MY_SEP, lineterminator=EOL_SEP)
+        with open(output_target, "r", newline='', encoding='utf8') as output_object:
+            output_rows = csv.reader(output_object, delimiter=MY_SEP)
+            writer.writerow(next(output_rows))
+            for row in output_rows:
+                if not replaced or row[slice_index] not in replaced:
+                    writer.writerow(row)
+        with open(delta_target, "r", newline='', encoding='utf8') as delta_object:
+            writer.writerows(itertools.islice(csv.reader(delta_object, delimiter=MY_SEP), 1, None))
+    os.replace(scratch, output_target)
+    os.remove(delta_target)
+
+def read_output_header(output_target):
+    """
+    Read the header row of an output, None if there is no output yet
+    """
+    try:
+        with open(output_target, "r", newline='', encoding='utf8') as file_object:
+            return next(csv.reader(file_object, delimiter=MY_SEP), None)
+    except OSError:
+        return None
 
-        jobholder = os.path.join( PENDING, query_target )
+def attach_search_job(apisession, query_target, query_number, output_target):
+    """
+    Find the search job an interrupted run left for this query, if it is still
+    alive on the server. The output is cut back to the last checkpointed page,
+    and the job id, the number of records already written and where the output
+    stopped are returned.
+    """
+    query_state = load_checkpoint(query_target)['queries'].get(str(query_number), {})
+    query_jobid = query_state.get('job')
+    if not query_jobid or query_state.get('output') != output_target:
+        return (None, 0, None)
+
+    try:
+        query_output = apisession.search_job_status(query_jobid)
+    except requests.exceptions.RequestException:
+        return (None, 0, None)
+    if query_output['state'] == 'CANCELLED':
+        return (None, 0, None)
+
+    start_offset = query_state.get('offset', 0)
+    output_state = None
+    if ARGS.OUT_FORMAT in COLUMNAR_FORMATS:
+        start_offset = 0
+    elif start_offset > 0:
+        output_state = { 'part': query_state.get('part', 1), 'rows': query_state.get('rows', 0), \
+                         'size': query_state.get('size', 0) }
+        try:
+            cut_query_output(output_target, output_state)
+        except OSError:
+            (start_offset, output_state) = (0, None)
+
+    register_search_job(query_jobid, query_target, output_target)
+    if ARGS.VERBOSE > 3:
+        print(f'SUMOQUERY.attached: {query_jobid} offset: {start_offset}')
 
-        for query_item in query_list:
-            query_data = collect_contents(query_item)
-            query_data = tailor_queries(query_data, query_target)
-            if ARGS.VERBOSE > 7:
-                print(f'SUMOQUERY.query_item: {query_item}')
-                print(f'SUMOQUERY.query_data: {query_data}')
-            header_output = run_sumo_query(apisession, query_data, time_params)
-            write_query_output(header_output, query_target, querycounter)
-            querycounter += 1
-            time.sleep(random.randint(0,MY_SLEEP))
-        time.sleep(random.randint(0,MY_SLEEP))
+    return (query_jobid, start_offset, output_state)
 
+def register_search_job(query_jobid, query_target, output_target):
+    """
+    Record a live search job in the job registry, so that it can be reaped
+    if this run dies before the job is deleted
+    """
+    job_entry = {
+        'id': query_jobid,
+        'target': query_target,
+        'output': output_target,
+        'host': os.uname()[1],
+        'pid': os.getpid(),
+        'created': int(time.time())
+    }
+    with open(os.path.join( JOBS, query_jobid ), "w", encoding='utf8') as file_object:
+        file_object.write(json.dumps(job_entry))
+
+def retire_search_job(apisession, query_jobid):
+    """
+    Delete a search job whose results are no longer needed, freeing its slot
+    on the server, and drop it from the job registry once it is gone
+    """
+    jobholder = os.path.join( JOBS, query_jobid )
+    if not os.path.exists(jobholder):
+        return
+    try:
+        apisession.delete_search_job(query_jobid)
+    except requests.exceptions.HTTPError as delete_error:
+        if delete_error.response is None or delete_error.response.status_code != 404:
+            if ARGS.VERBOSE > 2:
+                print(f'SUMOQUERY.delete: {query_jobid} :: {delete_error}')
+            return
+    except requests.exceptions.RequestException as delete_error:
+        if ARGS.VERBOSE > 2:
+            print(f'SUMOQUERY.delete: {query_jobid} :: {delete_error}')
+        return
+    if ARGS.VERBOSE > 4:
+        print(f'SUMOQUERY.deleted: {query_jobid}')
+    try:
         os.remove(jobholder)
+    except FileNotFoundError:
+        pass
+
+def reap_search_jobs(apisession):
+    """
+    Cancel and delete the registered search jobs of runs that are no longer
+    alive. Jobs of runs still going on this host are left alone.
+    """
+    for query_jobid in os.listdir(JOBS):
+        try:
+            with open(os.path.join( JOBS, query_jobid ), "r", encoding='utf8') as file_object:
+                job_entry = json.load(file_object)
+        except (OSError, ValueError):
+            job_entry = {}
+        if job_entry.get('host') == os.uname()[1] and job_entry.get('pid') != os.getpid():
+            try:
+                os.kill(job_entry['pid'], 0)
+                continue
+            except (KeyError, TypeError, ProcessLookupError):
+                pass
+            except PermissionError:
+                continue
+        if ARGS.VERBOSE > 3:
+            print(f'SUMOQUERY.reap: {query_jobid} {job_entry.get("target", "")}')
+        retire_search_job(apisession, query_jobid)
 
 def resolve_targets(target_org_list):
     """
@@ -249,36 +718,163 @@ def resolve_targets(target_org_list):
 
     return query_targets
 
-def write_query_output(header_output, query_target, query_number):
+def build_output_target(query_target, query_number):
     """
-    This is a wrapper for writing out the contents of a file
+    This builds the name of the output file for a target and query number
     """
 
     ext_sep = '.'
 
     querytag = QUERY_TAG + '.' + query_target
 
-    extension = ARGS.OUT_FORMAT
+    extension = OUTPUT_EXT
     number = f'{query_number:03d}'
 
     output_file = ext_sep.join((querytag, str(number), extension))
+    if ARGS.COMPRESS and ARGS.OUT_FORMAT not in COLUMNAR_FORMATS:
+        output_file = ext_sep.join((output_file, COMPRESS_EXT[ARGS.COMPRESS]))
     output_target = os.path.join(OUTPUTS, output_file)
 
     if ARGS.VERBOSE > 3:
         print(f'SUMOQUERY.outputfile: {output_target}')
 
-    with open(output_target, "w", encoding='utf8') as file_object:
-        file_object.write(header_output + '\n' )
-        file_object.close()
+    return output_target
+
+def write_query_output(output_target, query_pages, output_state=None, page_written=None):
+    """
+    This streams the query output to a file one page at a time.
+    The header is written with the first page, and every page is written out
+    as soon as it is serialized, so memory stays flat however many records return.
+    A resumed output carries on from the output_state of its last checkpoint.
+    The optional page_written callback gets the page size and the output state.
+    """
+
+    if ARGS.OUT_FORMAT in COLUMNAR_FORMATS:
+        write_columnar_output(output_target, query_pages, page_written)
+        return
+
+    serializer = None
+    query_output = QueryOutput(output_target, output_state, page_written)
+    try:
+        for query_records in RUN_METRICS.timed(query_pages, 'page'):
+            if serializer is None:
+                serializer = MessageSerializer(query_records['fields']) if ARGS.MESSAGES \
+                    else RecordSerializer(query_records['fields'], MY_SEP)
+                query_output.serializer = serializer
+            with RUN_METRICS.timer('serialize'):
+                rows = serializer.rows(query_records[RESULT_KEY])
+            RUN_METRICS.count('records', len(rows))
+            query_output.write_page(rows, len(query_records[RESULT_KEY]))
+        if serializer is None and output_state is None and not ARGS.MESSAGES:
+            query_output.serializer = RecordSerializer([], MY_SEP)
+            query_output.write_page([('NORECORDS',)], 0)
+    finally:
+        query_output.close()
+
+def build_output_part(output_target, part):
+    """
+    This names a part of a rolling output, such as sumoquery.abc_1234.001.part0001.csv.gz
+    """
+    if not ROLLING:
+        return output_target
+    (output_base, ext_sep, output_tail) = output_target.rpartition('.' + OUTPUT_EXT)
+    return f'{output_base}.part{part:04d}{ext_sep}{output_tail}'
+
+def cut_query_output(output_target, output_state):
+    """
+    This cuts an output back to the checkpointed end of its last page, removing
+    any parts started after it
+    """
+    os.truncate(build_output_part(output_target, output_state['part']), output_state['size'])
+    part = output_state['part'] + 1
+    while ROLLING and os.path.exists(build_output_part(output_target, part)):
+        os.remove(build_output_part(output_target, part))
+        part += 1
+
+def write_columnar_output(output_target, query_pages, page_written=None):
+    """
+    This streams the query output to a parquet or feather file, each page
+    becoming a row group or record batch. The schema is taken from the fields
+    of the first page, with numeric and boolean Sumo fields typed. A columnar
+    file cannot be appended to, so resumed outputs are written again whole.
+    """
+
+    writer = None
+    with open(output_target, "wb") as file_object:
+        try:
+            for query_records in RUN_METRICS.timed(query_pages, 'page'):
+                if writer is None:
+                    schema = build_schema(query_records)
+                    writer = open_columnar_writer(file_object, schema)
+                with RUN_METRICS.timer('serialize'):
+                    batch = build_batch(query_records, schema)
+                RUN_METRICS.count('records', batch.num_rows)
+                with RUN_METRICS.timer('write'):
+                    writer.write_batch(batch)
+                    file_object.flush()
+                if page_written is not None:
+                    page_written(len(query_records["records"]), size=file_object.tell())
+            if writer is None:
+                writer = open_columnar_writer(file_object, pyarrow.schema([]))
+        finally:
+            if writer is not None:
+                writer.close()
+
+def open_columnar_writer(file_object, schema):
+    """
+    This opens a parquet or an arrow ipc (feather) writer on the output
+    """
+    if ARGS.OUT_FORMAT == 'parquet':
+        return pyarrow.parquet.ParquetWriter(file_object, schema, \
+                                             compression=ARGS.COMPRESS or 'snappy')
+    return pyarrow.ipc.new_file(file_object, schema, \
+                                options=pyarrow.ipc.IpcWriteOptions(compression=ARGS.COMPRESS))
+
+def build_schema(query_records):
+    """
+    This builds the arrow schema of the output from the fields of query_records
+    """
+    return pyarrow.schema([ (field['name'], ARROW_TYPES.get(field.get('fieldType'), 'string')) \
+                            for field in query_records['fields'] ])
+
+def build_batch(query_records, schema):
+    """
+    This turns the records of a page into a record batch of typed columns.
+    Values that do not read as their field type are left empty.
+    """
+    columns = []
+    for field in schema:
+        values = [ record["map"].get(field.name) for record in query_records["records"] ]
+        if pyarrow.types.is_integer(field.type):
+            values = [ convert_value(parse_number(value), int) for value in values ]
+        elif pyarrow.types.is_floating(field.type):
+            values = [ convert_value(parse_number(value), float) for value in values ]
+        elif pyarrow.types.is_boolean(field.type):
+            values = [ None if value is None else str(value).lower() == 'true' \
+                       for value in values ]
+        columns.append(pyarrow.array(values, type=field.type))
+    return pyarrow.RecordBatch.from_arrays(columns, schema=schema)
+
+def convert_value(number, number_type):
+    """
+    This casts a parsed number to the column type, keeping empty values empty
+    """
+    try:
+        return None if number is None else number_type(number)
+    except (ValueError, OverflowError):
+        return None
 
 def tailor_queries(query_item, query_target):
     """
     This substitutes common parameters for values from the script.
     Later, this will be a data driven exercise.
     """
+    target_parts = query_target.split('_')
+    if len(target_parts) < 2:
+        raise ValueError(f'target {query_target} is not <deployment>_<orgid>')
     replacements = {}
-    replacements['{{deployment}}'] = query_target.split('_')[0]
-    replacements['{{org_id}}'] = query_target.split('_')[1]
+    replacements['{{deployment}}'] = target_parts[0]
+    replacements['{{org_id}}'] = target_parts[1]
     replacements['{{longquery_limit_stmt}}'] = str(LONGQUERY_LIMIT)
     replacements['{{key}}'] = query_target
     for sub_key, sub_value in replacements.items():
@@ -312,6 +908,25 @@ def calculate_range():
     TIME_PARAMS["by_receipt_time"] = False
     return TIME_PARAMS
 
+def parse_period(period_marker):
+    """
+    This turns a period such as 15m or 1d into milliseconds
+    """
+    period_number = re.match(r'\d+', period_marker.replace('-', ''))
+    period_unit = period_marker.replace('-', '').replace(period_number.group(), '')
+    return int(period_number.group()) * int(TIME_TABLE[period_unit])
+
+def align_range(time_params, boundary):
+    """
+    This snaps the range back to a boundary, keeping its length, so runs a
+    little apart ask the same question and can share cached outputs
+    """
+    aligned_params = dict(time_params)
+    shift = time_params["time_to"] % boundary
+    aligned_params["time_to"] = time_params["time_to"] - shift
+    aligned_params["time_from"] = time_params["time_from"] - shift
+    return aligned_params
+
 def collect_queries():
     """
     Scoop up a query if a directory, file or a string
@@ -347,77 +962,380 @@ def collect_contents(query_item):
             file_object.close()
     return query
 
-def run_sumo_query(apisession, query, time_params):
+def run_sumo_query(apisession, query, time_params, output_target, query_target, query_number):
+    """
+    This runs the Sumo Command, and then saves the output and the status.
+    Each search job holds a slot of the target's job budget until its records
+    are fetched, waiting in the scheduler queue when the budget is full.
+    With -p a job left alive by an interrupted run is picked up again, and
+    paging carries on from the last page that was written.
+    With --messages the raw messages are paged instead of the records.
     """
-    This runs the Sumo Command, and then saves the output and the status
+    if ARGS.MESSAGES:
+        check_message_query(query)
+
+    if ARGS.SPLITS > 1:
+        merge_plan = False
+        try:
+            merge_plan = plan_split_merge(query)
+        except ValueError as split_error:
+            if ARGS.VERBOSE > 2:
+                print(f'SUMOQUERY.split: {split_error}, running as a single job')
+        if merge_plan is not False:
+            return run_split_query(apisession, query, time_params, output_target, \
+                                   query_target, merge_plan)
+
+    job_ticket = JOB_SCHEDULER.acquire(query_target, time_params)
+    query_jobid = None
+    try:
+        (start_offset, output_state) = (0, None)
+        if ARGS.CLEANUP:
+            (query_jobid, start_offset, output_state) = attach_search_job( \
+                apisession, query_target, query_number, output_target)
+        if query_jobid is None:
+            with RUN_METRICS.timer('create'):
+                query_job = apisession.search_job(query, time_params)
+            query_jobid = query_job["id"]
+            register_search_job(query_jobid, query_target, output_target)
+            save_checkpoint(query_target, query_number, job=query_jobid, state='SUBMITTED', \
+                            offset=0, size=0, output=output_target)
+            if ARGS.VERBOSE > 3:
+                print(f'SUMOQUERY.jobid: {query_jobid}')
+        RUN_METRICS.note(job=query_jobid)
+
+        if ARGS.PROGRESSIVE:
+            query_pages = fetch_progressive_pages(apisession, query_jobid, start_offset)
+        else:
+            with RUN_METRICS.timer('poll'):
+                (query_status, num_messages, num_records, pages) = \
+                    apisession.search_job_tally(query_jobid)
+            save_checkpoint(query_target, query_number, state=query_status)
+            if ARGS.VERBOSE > 4:
+                print(f'SUMOQUERY.status: {query_status}')
+                print(f'SUMOQUERY.records: {num_records}')
+                print(f'SUMOQUERY.messages: {num_messages}')
+                print(f'SUMOQUERY.pages: {pages}')
+            num_results = num_messages if ARGS.MESSAGES else num_records
+            query_pages = fetch_result_pages(apisession, query_jobid, num_results, start_offset)
+
+        query_progress = {'offset': start_offset}
+        def checkpoint_page(num_page_records, **output_state):
+            query_progress['offset'] += num_page_records
+            save_checkpoint(query_target, query_number, offset=query_progress['offset'], \
+                            **output_state)
+
+        write_query_output(output_target, query_pages, output_state, checkpoint_page)
+    finally:
+        if query_jobid is not None:
+            retire_search_job(apisession, query_jobid)
+        JOB_SCHEDULER.release(job_ticket)
+
+    return query_jobid
+
+def run_split_query(apisession, query, time_params, output_target, query_target, merge_plan):
+    """
+    This runs the query as concurrent search jobs over consecutive windows of the
+    range. Shard pages are concatenated in window order, or re-aggregated on the
+    grouping columns when the query ends in an additive aggregate.
+    The budget slots for all shards are taken together, so split queries never
+    hold some slots while waiting on others.
+    """
+    time_windows = split_range(time_params, JOB_SCHEDULER.max_slots(ARGS.SPLITS))
+    job_ticket = JOB_SCHEDULER.acquire(query_target, time_params, len(time_windows))
+    shard_jobs = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(time_windows)) as executor:
+            shard_futures = [ executor.submit(RUN_METRICS.bind(run_query_shard), apisession, \
+                                              query, time_window, query_target, output_target) \
+                              for time_window in time_windows ]
+        shard_jobs = [ future.result() for future in shard_futures \
+                       if future.exception() is None ]
+        RUN_METRICS.note(job=[ query_jobid for query_jobid, _num_results in shard_jobs ])
+        for future in shard_futures:
+            if future.exception() is not None:
+                raise future.exception()
+
+        query_pages = itertools.chain.from_iterable( \
+            fetch_shard_pages(apisession, query_jobid, num_results, job_ticket) \
+            for query_jobid, num_results in shard_jobs)
+
+        if merge_plan:
+            query_pages = merge_record_pages(query_pages, merge_plan)
+
+        write_query_output(output_target, query_pages)
+    finally:
+        for query_jobid, _num_results in shard_jobs:
+            retire_search_job(apisession, query_jobid)
+        JOB_SCHEDULER.release(job_ticket)
+
+    return [ query_jobid for query_jobid, _num_results in shard_jobs ]
+
+def run_query_shard(apisession, query, time_params, query_target, output_target):
     """
-    query_job = apisession.search_job(query, time_params)
+    This runs one window of a split query through to the end of gathering
+    """
+    with RUN_METRICS.timer('create'):
+        query_job = apisession.search_job(query, time_params)
     query_jobid = query_job["id"]
+    register_search_job(query_jobid, query_target, output_target)
     if ARGS.VERBOSE > 3:
         print(f'SUMOQUERY.jobid: {query_jobid}')
 
-    (query_status, num_messages, num_records, iterations) = apisession.search_job_tally(query_jobid)
+    try:
+        with RUN_METRICS.timer('poll'):
+            (query_status, num_messages, num_records, pages) = \
+                apisession.search_job_tally(query_jobid)
+    except Exception:
+        retire_search_job(apisession, query_jobid)
+        raise
+
     if ARGS.VERBOSE > 4:
+        print(f'SUMOQUERY.window: {time_params["time_from"]}:{time_params["time_to"]}')
         print(f'SUMOQUERY.status: {query_status}')
         print(f'SUMOQUERY.records: {num_records}')
         print(f'SUMOQUERY.messages: {num_messages}')
-        print(f'SUMOQUERY.iterations: {iterations}')
-
-    assembled_output = build_assembled_output(apisession, query_jobid, num_records, iterations)
+        print(f'SUMOQUERY.pages: {pages}')
 
-    return assembled_output
+    return (query_jobid, num_messages if ARGS.MESSAGES else num_records)
 
-def build_assembled_output(apisession, query_jobid, num_records, iterations):
+def fetch_shard_pages(apisession, query_jobid, num_results, job_ticket):
     """
-    This assembles the header and output, going through the iterations of the output
+    This fetches the pages of one shard, then deletes its search job and
+    gives back its slot
     """
+    yield from fetch_result_pages(apisession, query_jobid, num_results)
+    retire_search_job(apisession, query_jobid)
+    JOB_SCHEDULER.release(job_ticket, 1)
 
-    if num_records == 0:
-        assembled_output = 'NORECORDS'
-    if num_records > 0:
-        total_records = ''
-        for my_counter in range(0, iterations, 1):
-            my_limit = LIMIT
-            my_offset = ( my_limit * my_counter )
+def split_range(time_params, splits):
+    """
+    This cuts the query range into consecutive windows of close to equal length
+    """
+    time_from = time_params["time_from"]
+    time_to = time_params["time_to"]
+    window_length = max(1, -(-(time_to - time_from) // splits))
 
-            query_records = apisession.search_job_records(query_jobid, my_limit, my_offset)
+    time_windows = []
+    for window_from in range(time_from, time_to, window_length):
+        time_window = dict(time_params)
+        time_window["time_from"] = window_from
+        time_window["time_to"] = min(window_from + window_length, time_to)
+        time_windows.append(time_window)
 
-            header,header_list = build_header(query_records)
-            output = build_body(query_records,header_list)
-            total_records = total_records + output
+    return time_windows
 
-        assembled_output = EOL_SEP.join([ header , total_records ])
+def split_query_stages(query):
+    """
+    This splits a query on the pipes that are not inside of quotes,
+    dropping any comment lines first
+    """
+    query = re.sub(r'^\s*//.*$', '', query, flags=re.MULTILINE)
+
+    query_stages = []
+    query_stage = []
+    quoted = False
+    for character in query:
+        if character == '"':
+            quoted = not quoted
+        if character == '|' and not quoted:
+            query_stages.append(''.join(query_stage).strip())
+            query_stage = []
+        else:
+            query_stage.append(character)
+    query_stages.append(''.join(query_stage).strip())
 
-    return assembled_output
+    return query_stages
 
-def build_header(query_records):
+def query_operators(query):
     """
-    This builds the header of the output from the results of query_records
+    This lists the operator of every stage of a query after the search
     """
+    return [ re.split(r'[\s(]', stage.lower(), maxsplit=1)[0] \
+             for stage in split_query_stages(query)[1:] ]
 
-    header_list = []
-    dataframe = pandas.DataFrame.from_records(query_records['fields'])
-    myfielddf = pandas.DataFrame(dataframe, columns=['name'])
-    header_list = myfielddf.to_csv(header=None, index=False).strip('\n').split('\n')
-    header = MY_SEP.join(header_list)
+def check_message_query(query):
+    """
+    Messages only come back from queries without an aggregate, refuse the others
+    """
+    for operator in query_operators(query):
+        if operator in AGGREGATE_OPERATORS:
+            raise ValueError(f'--messages needs a non aggregate query, found {operator}')
 
-    return header, header_list
+def plan_split_merge(query):
+    """
+    This works out how shard outputs can be merged. It returns None when the
+    outputs can just be concatenated, or when the query ends in count, sum, min
+    or max, a plan of the aggregate of each output column and the sort to apply
+    again once the shards are merged. Only sort or order may follow the aggregate,
+    a fields stage could drop the grouping columns the merge is keyed on.
+    Anything else is refused, sorted concatenations included.
+    """
+    query_stages = split_query_stages(query)[1:]
+    operators = query_operators(query)
+
+    aggregates = [ index for index, operator in enumerate(operators) \
+                   if operator in AGGREGATE_OPERATORS ]
+    if not aggregates:
+        for operator in operators:
+            if operator in SPLIT_UNSAFE_OPERATORS:
+                raise ValueError(f'{operator} does not split across time windows')
+        return None
+
+    if len(aggregates) > 1:
+        raise ValueError('nested aggregates do not split across time windows')
+
+    sort_keys = []
+    for stage_index, operator in enumerate(operators[aggregates[0] + 1:], aggregates[0] + 1):
+        if operator not in SPLIT_SORT_OPERATORS:
+            raise ValueError(f'{operator} after an aggregate does not split across time windows')
+        sort_keys = parse_sort_stage(query_stages[stage_index])
+
+    aggregate_stage = re.split(r'\s+by\s+', query_stages[aggregates[0]], \
+                               flags=re.IGNORECASE)[0]
+    merge_plan = {}
+    for aggregate in re.split(r',\s*(?![^()]*\))', aggregate_stage):
+        aggregate_match = re.match(r'^(\w+)\s*(\(.*\))?\s*(as\s+(\w+))?$', \
+                                   aggregate.strip(), flags=re.IGNORECASE)
+        if aggregate_match is None:
+            raise ValueError(f'cannot read aggregate {aggregate.strip()}')
+        operator = aggregate_match.group(1).lower()
+        if operator not in ADDITIVE_OPERATORS:
+            raise ValueError(f'{operator} is not additive across time windows')
+        column = aggregate_match.group(4) or ADDITIVE_OPERATORS[operator]
+        merge_plan[column.lower()] = operator
+
+    return {'columns': merge_plan, 'sort': sort_keys}
+
+def parse_sort_stage(query_stage):
+    """
+    This reads a sort or order stage into a list of column and descending pairs.
+    Columns sort descending unless marked asc or with a leading +.
+    """
+    sort_columns = re.sub(r'^\w+\s+(by\s+)?', '', query_stage.strip(), flags=re.IGNORECASE)
+    sort_keys = []
+    for sort_column in sort_columns.split(','):
+        sort_match = re.match(r'^([+-])?\s*(\w+)(\s+(asc|desc))?$', sort_column.strip(), \
+                              flags=re.IGNORECASE)
+        if sort_match is None:
+            raise ValueError(f'cannot read sort {sort_column.strip()}')
+        descending = sort_match.group(1) != '+' and \
+                     (sort_match.group(4) or 'desc').lower() == 'desc'
+        sort_keys.append((sort_match.group(2).lower(), descending))
+    return sort_keys
+
+def sort_value(value):
+    """
+    This orders numbers before text, and numbers by their value
+    """
+    number = parse_number(value)
+    if number is not None:
+        return (0, number, '')
+    return (1, 0, '' if value is None else str(value))
 
-def build_body(query_records, header_list):
+def merge_record_pages(query_pages, merge_plan):
+    """
+    This re-aggregates shard records on their grouping columns, adding up
+    count and sum columns and keeping the lowest min and highest max, then
+    applies the sort of the query again to the merged records
+    """
+    fields = None
+    merged_records = {}
+    for query_records in query_pages:
+        if fields is None:
+            fields = query_records["fields"]
+            merge_columns = { field["name"]: merge_plan['columns'][field["name"].lower()] \
+                              for field in fields \
+                              if field["name"].lower() in merge_plan['columns'] }
+            key_columns = [ field["name"] for field in fields \
+                            if field["name"] not in merge_columns ]
+            if ARGS.VERBOSE > 2 and len(merge_columns) != len(merge_plan['columns']):
+                print(f'SUMOQUERY.split: aggregate columns missing from {key_columns}')
+        for record in query_records["records"]:
+            record_map = record["map"]
+            record_key = tuple(record_map[column] for column in key_columns)
+            merged_map = merged_records.get(record_key)
+            if merged_map is None:
+                merged_records[record_key] = dict(record_map)
+                continue
+            for column, operator in merge_columns.items():
+                merged_map[column] = merge_value(operator, merged_map[column], record_map[column])
+
+    if fields is not None:
+        record_maps = list(merged_records.values())
+        field_names = { field["name"].lower(): field["name"] for field in fields }
+        for column, descending in reversed(merge_plan['sort']):
+            field_name = field_names.get(column, column)
+            record_maps.sort(key=lambda record_map: sort_value(record_map.get(field_name)), \
+                             reverse=descending)
+        yield {'fields': fields, \
+               'records': [ {'map': record_map} for record_map in record_maps ]}
+
+def merge_value(operator, merged_value, record_value):
+    """
+    This combines two aggregate values from different shards
+    """
+    merged_number = parse_number(merged_value)
+    record_number = parse_number(record_value)
+    if merged_number is None or record_number is None:
+        return merged_value if record_number is None else record_value
+    if operator in ('count', 'sum'):
+        return str(merged_number + record_number)
+    if operator == 'min':
+        return str(min(merged_number, record_number))
+    return str(max(merged_number, record_number))
+
+def parse_number(value):
+    """
+    This reads an aggregate value as an int where possible, else a float
     """
-    This builds the body of the output from the results of query_records
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+def fetch_result_pages(apisession, query_jobid, num_results, start_offset=0):
     """
-    record_body_list = []
-    for record in query_records["records"]:
-        record_line_list = []
-        for header in header_list:
-            recordlist = str(record["map"][header]).replace(',','|')
-            record_line_list.append(recordlist)
-            record_line = MY_SEP.join(record_line_list)
-        record_body_list.append(record_line)
-    output = EOL_SEP.join(record_body_list)
+    This fetches the record pages, or with --messages the message pages, of a
+    finished job using a bounded pool of concurrent requests, and hands the
+    pages back in offset order
+    """
+    fetch_page = apisession.search_job_messages if ARGS.MESSAGES \
+        else apisession.search_job_records
+    fetchers = max(1, ARGS.FETCHERS)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=fetchers) as executor:
+        pending = collections.deque()
+        for my_offset in range(start_offset, num_results, LIMIT):
+            pending.append(executor.submit(RUN_METRICS.bind(fetch_page), query_jobid, \
+                                           LIMIT, my_offset))
+            if len(pending) >= fetchers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def fetch_progressive_pages(apisession, query_jobid, start_offset=0):
+    """
+    This hands back result pages while the job is still gathering results.
+    Only pages that are already full are fetched early, the remainder follows
+    once the job is done. Aggregate records can still change while the job
+    gathers, so this is meant for messages, or queries whose records only ever grow.
+    """
+    fetched = start_offset
+    for query_output in apisession.search_job_poll(query_jobid):
+        num_results = query_output[RESULT_COUNT]
+        if query_output['state'] in POLL_STATES:
+            num_results = num_results - num_results % LIMIT
+        if num_results > fetched:
+            yield from fetch_result_pages(apisession, query_jobid, num_results, fetched)
+            fetched = num_results
 
-    return output
+    if ARGS.VERBOSE > 4:
+        print(f'SUMOQUERY.status: {query_output["state"]}')
+        print(f'SUMOQUERY.records: {query_output["recordCount"]}')
+        print(f'SUMOQUERY.messages: {query_output["messageCount"]}')
+        print(f'SUMOQUERY.pages: {-(-fetched // LIMIT)}')
 
 ### class ###
 class SumoApiClient():
@@ -431,12 +1349,7 @@ class SumoApiClient():
         Initializes the Sumo Logic object
         """
 
-        self.retry_strategy = Retry(
-            total=10,
-            status_forcelist=[429, 500, 502, 503, 504],
-            allowed_methods=["HEAD", "GET", "OPTIONS"]
-        )
-        self.adapter = HTTPAdapter(max_retries=self.retry_strategy)
+        self.adapter = HTTPAdapter(pool_maxsize=max(10, ARGS.WORKERS * ARGS.FETCHERS))
 
         self.session = requests.Session()
 
@@ -446,6 +1359,7 @@ class SumoApiClient():
         self.session.auth = (access_id, access_key)
         self.session.headers = {'content-type': 'application/json', \
             'accept': 'application/json'}
+        self.limiter = RateLimiter(access_id, ARGS.API_RATE, ARGS.API_BURST)
         cookiejar = http.cookiejar.FileCookieJar(cookie_file)
         self.session.cookies = cookiejar
         if endpoint is None:
@@ -463,53 +1377,91 @@ class SumoApiClient():
         It contacts the default REST endpoint and resolves the 401 to get the right endpoint.
         """
         self.endpoint = 'https://api.sumologic.com/api'
+        self.limiter.acquire()
         self.response = self.session.get('https://api.sumologic.com/api/v1/collectors')
         endpoint = self.response.url.replace('/v1/collectors', '')
         return endpoint
 
-    def delete(self, method, params=None, headers=None, data=None):
+    def _request(self, verb, method, **kwargs):
         """
-        Defines a Sumo Logic Delete operation
+        Sends a request through the rate limiter, retrying throttled and failed
+        ones. A search job POST whose connection broke after it was sent is not
+        retried, retry_safe explains why; a job it may have created is never
+        known, so it is left to time out on the server.
+        Each attempt, its bytes and time, each retry and each wait are counted
+        in the run metrics, by the kind of call.
         """
-        response = self.session.delete(self.endpoint + method, \
-            params=params, headers=headers, data=data)
+        request_kind = self._request_kind(verb, method)
+        backoff = RetryBackoff()
+        while True:
+            RUN_METRICS.slept('rate_wait', self.limiter.acquire())
+            request_error = None
+            start_time = time.perf_counter()
+            try:
+                response = self.session.request(verb, self.endpoint + method, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+                (response, request_error) = (None, error)
+            RUN_METRICS.count('requests')
+            RUN_METRICS.count(f'requests_{request_kind}')
+            RUN_METRICS.count(f'http_{request_kind}_s', time.perf_counter() - start_time)
+            RUN_METRICS.count('bytes_sent', len(kwargs.get('data') or ''))
+            if response is not None:
+                RUN_METRICS.count('bytes_received', len(response.content))
+            if request_error is not None and not retry_safe(verb, request_error):
+                raise request_error
+            if response is not None and response.status_code not in RETRY_STATUS:
+                break
+            wait = backoff.wait(response)
+            if wait is None:
+                if request_error is not None:
+                    raise request_error
+                break
+            RUN_METRICS.count('retries')
+            RUN_METRICS.slept('retry_wait', wait)
+            time.sleep(wait)
         if response.status_code != 200:
             response.reason = response.text
         response.raise_for_status()
         return response
 
+    @staticmethod
+    def _request_kind(verb, method):
+        """
+        Name the kind of search job call a request is, for the run metrics
+        """
+        if verb == 'DELETE':
+            return 'delete'
+        if verb == 'POST':
+            return 'create'
+        if method.endswith(('/records', '/messages')):
+            return 'page'
+        return 'poll'
+
+    def delete(self, method, params=None, headers=None, data=None):
+        """
+        Defines a Sumo Logic Delete operation
+        """
+        return self._request('DELETE', method, params=params, headers=headers, data=data)
+
     def get(self, method, params=None, headers=None):
         """
         Defines a Sumo Logic Get operation
         """
-        response = self.session.get(self.endpoint + method, \
-            params=params, headers=headers)
-        if response.status_code != 200:
-            response.reason = response.text
-        response.raise_for_status()
-        return response
+        return self._request('GET', method, params=params, headers=headers)
 
     def post(self, method, data, headers=None, params=None):
         """
         Defines a Sumo Logic Post operation
         """
-        response = self.session.post(self.endpoint + method, \
-            data=json.dumps(data), headers=headers, params=params)
-        if response.status_code != 200:
-            response.reason = response.text
-        response.raise_for_status()
-        return response
+        return self._request('POST', method, data=json.dumps(data), headers=headers, \
+                             params=params)
 
     def put(self, method, data, headers=None, params=None):
         """
         Defines a Sumo Logic Put operation
         """
-        response = self.session.put(self.endpoint + method, \
-            data=json.dumps(data), headers=headers, params=params)
-        if response.status_code != 200:
-            response.reason = response.text
-        response.raise_for_status()
-        return response
+        return self._request('PUT', method, data=json.dumps(data), headers=headers, \
+                             params=params)
 
 ### class ###
 ### methods ###
@@ -548,7 +1500,6 @@ class SumoApiClient():
         """
         job_records = []
         iterations = num_records // LIMIT + 1
-        time.sleep(random.randint(0,MY_SLEEP))
         for iteration in range(1, iterations + 1):
             records = self.search_job_records(query_jobid, limit=LIMIT,
                                               offset=((iteration - 1) * LIMIT))
@@ -557,44 +1508,56 @@ class SumoApiClient():
 
         return job_records
 
-    def search_job_tally(self, query_jobid):
+    def search_job_poll(self, query_jobid):
         """
-        Find out search job messages
+        Poll the search job status until it stops gathering, yielding each status.
+        The wait starts short and resets whenever the counts grow, otherwise it
+        backs off exponentially with jitter up to the sleep time cap.
         """
-        query_output = self.search_job_status(query_jobid)
-        query_status = query_output['state']
-        num_messages = query_output['messageCount']
-        num_records = query_output['recordCount']
-        time.sleep(random.randint(0,MY_SLEEP))
-        iterations = 1
-        while query_status == 'GATHERING RESULTS':
+        poll_max = max(POLL_MIN, MY_SLEEP)
+        poll_wait = POLL_MIN
+        last_counts = None
+        while True:
             query_output = self.search_job_status(query_jobid)
+            yield query_output
+            if query_output['state'] not in POLL_STATES:
+                return
+            counts = (query_output['messageCount'], query_output['recordCount'])
+            if counts != last_counts:
+                poll_wait = POLL_MIN
+            else:
+                poll_wait = min(poll_wait * 2, poll_max)
+            last_counts = counts
+            poll_sleep = random.uniform(poll_wait / 2, poll_wait)
+            RUN_METRICS.slept('poll_sleep', poll_sleep)
+            time.sleep(poll_sleep)
+
+    def search_job_tally(self, query_jobid):
+        """
+        Wait for the search job to finish, then report the final state, the
+        message and record counts, and the number of record pages to fetch
+        """
+        for query_output in self.search_job_poll(query_jobid):
             query_status = query_output['state']
             num_messages = query_output['messageCount']
             num_records = query_output['recordCount']
-            time.sleep(random.randint(0,MY_SLEEP))
-            iterations += 1
-        return (query_status, num_messages, num_records, iterations)
+        pages = -(-num_records // LIMIT)
+        return (query_status, num_messages, num_records, pages)
 
     def calculate_and_fetch_messages(self, query_jobid, num_messages):
         """
         Calculate and return messages in chunks based on LIMIT
         """
         job_messages = []
-        iterations = num_messages // LIMIT + 1
-        for iteration in range(1, iterations + 1):
-            time.sleep(random.randint(0,MY_SLEEP))
-            records = self.search_job_records(query_jobid, limit=LIMIT,
-                                              offset=((iteration - 1) * LIMIT))
-            for record in records['records']:
-                job_messages.append(record)
+        for my_offset in range(0, num_messages, LIMIT):
+            messages = self.search_job_messages(query_jobid, limit=LIMIT, offset=my_offset)
+            job_messages.extend(messages['messages'])
         return job_messages
 
     def search_job_messages(self, query_jobid, limit=None, offset=0):
         """
         Query the job messages of a search job
         """
-        time.sleep(random.randint(0,MY_SLEEP))
         params = {'limit': limit, 'offset': offset}
         response = self.get('/v1/search/jobs/' + str(query_jobid) + '/messages', params)
         return json.loads(response.text)
@@ -603,7 +1566,6 @@ class SumoApiClient():
         """
         Query the job records of a search job
         """
-        time.sleep(random.randint(0,MY_SLEEP))
         params = {'limit': limit, 'offset': offset}
         response = self.get('/v1/search/jobs/' + str(query_jobid) + '/records', params)
         return json.loads(response.text)
@@ -616,5 +1578,254 @@ class SumoApiClient():
 
 ### methods ###
 
+### class ###
+class SearchJobScheduler():
+    """
+    This keeps the active search jobs of each target within a budget.
+    Submissions over budget wait in a queue, and freed slots go to waiting jobs
+    either round robin across targets or to the shortest time range first.
+    """
+
+    def __init__(self, budget, total_budget=0, fairness='roundrobin'):
+        """
+        Initializes the scheduler with per target and total budgets
+        """
+        self.budget = max(1, budget)
+        self.total_budget = total_budget
+        self.fairness = fairness
+        self.condition = threading.Condition()
+        self.active = collections.Counter()
+        self.total_active = 0
+        self.waiting = []
+        self.turns = collections.deque()
+        self.sequence = itertools.count()
+
+    def max_slots(self, slots):
+        """
+        Cap a number of slots to what a single ticket can ever be granted
+        """
+        if self.total_budget > 0:
+            return max(1, min(slots, self.budget, self.total_budget))
+        return max(1, min(slots, self.budget))
+
+    def acquire(self, query_target, time_params, slots=1):
+        """
+        Wait for slots for search jobs on the target, and return their ticket
+        """
+        job_ticket = {
+            'target': query_target,
+            'range': time_params["time_to"] - time_params["time_from"],
+            'sequence': next(self.sequence),
+            'slots': self.max_slots(slots),
+            'held': 0,
+            'granted': False
+        }
+        with self.condition:
+            self.waiting.append(job_ticket)
+            if query_target not in self.turns:
+                self.turns.append(query_target)
+            self._dispatch()
+            while not job_ticket['granted']:
+                self.condition.wait()
+        return job_ticket
+
+    def release(self, job_ticket, slots=None):
+        """
+        Give back some or all of the slots held by a ticket
+        """
+        with self.condition:
+            if slots is None:
+                slots = job_ticket['held']
+            slots = min(slots, job_ticket['held'])
+            if slots < 1:
+                return
+            job_ticket['held'] -= slots
+            self.active[job_ticket['target']] -= slots
+            self.total_active -= slots
+            self._dispatch()
+
+    def _eligible(self, job_ticket):
+        """
+        A waiting ticket can start when its target and the total have room for it
+        """
+        if self.active[job_ticket['target']] + job_ticket['slots'] > self.budget:
+            return False
+        if self.total_budget > 0:
+            return self.total_active + job_ticket['slots'] <= self.total_budget
+        return True
+
+    def _dispatch(self):
+        """
+        Grant slots to waiting tickets in fairness order while there is room
+        """
+        granted = False
+        while self.waiting:
+            eligible = [ job_ticket for job_ticket in self.waiting if self._eligible(job_ticket) ]
+            if not eligible:
+                break
+            if self.fairness == 'shortest':
+                job_ticket = min(eligible, key=lambda ticket: (ticket['range'], ticket['sequence']))
+                self.turns.remove(job_ticket['target'])
+            else:
+                eligible_targets = { ticket['target'] for ticket in eligible }
+                while self.turns[0] not in eligible_targets:
+                    self.turns.rotate(-1)
+                query_target = self.turns.popleft()
+                job_ticket = next( ticket for ticket in eligible if ticket['target'] == query_target )
+            self.waiting.remove(job_ticket)
+            if any( ticket['target'] == job_ticket['target'] for ticket in self.waiting ):
+                self.turns.append(job_ticket['target'])
+            job_ticket['granted'] = True
+            job_ticket['held'] = job_ticket['slots']
+            self.active[job_ticket['target']] += job_ticket['slots']
+            self.total_active += job_ticket['slots']
+            granted = True
+        if granted:
+            self.condition.notify_all()
+
+class QueryOutput():
+    """
+    This is the output file, or the rolling parts of it, a query writes its
+    pages to. Compressed pages are written as gzip members or zstd frames of
+    their own, so an output can be cut back to the end of any page and carried on.
+    With a compression thread, pages are compressed and written while the next
+    ones are fetched.
+    """
+
+    def __init__(self, output_target, output_state=None, page_written=None):
+        """
+        Opens the output, or the part a resumed output stopped in
+        """
+        self.output_target = output_target
+        self.page_written = page_written
+        self.serializer = None
+        self.part = 1
+        self.rows = 0
+        self.size = 0
+        if output_state is not None:
+            self.part = output_state['part']
+            self.rows = output_state['rows']
+            self.size = output_state['size']
+        self.file_object = open(build_output_part(output_target, self.part), \
+                                "ab" if output_state is not None else "wb")
+        self.compressor = None
+        if ARGS.COMPRESS == 'zstd':
+            self.compressor = zstandard.ZstdCompressor()
+
+        self.pages = None
+        self.error = None
+        if ARGS.COMPRESS_THREAD:
+            self.pages = queue.Queue(maxsize=COMPRESS_QUEUE)
+            self.thread = threading.Thread(target=RUN_METRICS.bind(self._drain), daemon=True)
+            self.thread.start()
+
+    def write_page(self, rows, num_records):
+        """
+        Hands a page of rows to be written, or queues it for the compression thread
+        """
+        if self.pages is None:
+            self._write(rows, num_records)
+            return
+        if self.error is not None:
+            raise self.error
+        self.pages.put((rows, num_records))
+
+    def close(self):
+        """
+        Waits for queued pages to be written, then closes the output
+        """
+        if self.pages is not None:
+            self.pages.put(None)
+            self.thread.join()
+        self.file_object.close()
+        if self.error is not None:
+            raise self.error
+
+    def _drain(self):
+        """
+        Writes queued pages until the output is closed, keeping the first error
+        """
+        while True:
+            page = self.pages.get()
+            if page is None:
+                return
+            if self.error is None:
+                try:
+                    self._write(*page)
+                except Exception as write_error:
+                    self.error = write_error
+
+    def _write(self, rows, num_records):
+        """
+        Writes a page, rolling over to a new part whenever one fills up
+        """
+        if self.size == 0:
+            self._emit_header()
+        while rows:
+            if self._full():
+                self._roll()
+                self._emit_header()
+            take = len(rows)
+            if ARGS.ROLL_ROWS:
+                take = min(take, ARGS.ROLL_ROWS - self.rows)
+            self._emit(rows[:take])
+            self.rows += take
+            rows = rows[take:]
+        if self.page_written is not None:
+            self.page_written(num_records, part=self.part, rows=self.rows, size=self.size)
+
+    def _emit_header(self):
+        """
+        Writes the header at the top of a new part
+        """
+        if self.serializer.header_list:
+            self._emit([self.serializer.header_list])
+
+    def _emit(self, rows):
+        """
+        Serializes, compresses and writes rows to the current part
+        """
+        with RUN_METRICS.timer('serialize'):
+            data = self.serializer.format(rows).encode('utf8')
+        with RUN_METRICS.timer('write'):
+            if ARGS.COMPRESS == 'gzip':
+                data = gzip.compress(data)
+            elif self.compressor is not None:
+                data = self.compressor.compress(data)
+            self.file_object.write(data)
+            self.file_object.flush()
+        self.size += len(data)
+
+    def _full(self):
+        """
+        Tells whether the current part has reached its row or size limit
+        """
+        if not ROLLING or self.rows == 0:
+            return False
+        if ARGS.ROLL_ROWS and self.rows >= ARGS.ROLL_ROWS:
+            return True
+        return bool(ARGS.ROLL_SIZE) and self.size >= ARGS.ROLL_SIZE * 1024 * 1024
+
+    def _roll(self):
+        """
+        Closes the current part and starts the next one
+        """
+        self.file_object.close()
+        self.part += 1
+        self.rows = 0
+        self.size = 0
+        self.file_object = open(build_output_part(self.output_target, self.part), "wb")
+
+### class ###
+
+JOB_SCHEDULER = SearchJobScheduler(ARGS.JOB_BUDGET, ARGS.TOTAL_BUDGET, ARGS.FAIRNESS)
+
+RUN_METRICS = RunMetrics()
+
+RESULT_CACHE = None
+if ARGS.CACHE_TTL:
+    RESULT_CACHE = ResultCache(CACHE, parse_period(ARGS.CACHE_TTL) / SEC_M, \
+                               ARGS.CACHE_SIZE * 1024 * 1024)
+
 if __name__ == '__main__':
     main()
@@ -5,14 +5,29 @@
 Exaplanation: sumoquerysteam runs a query via the search job api and streams resulting records to a sumo HTTPS url in JSON format.
 
 The query must be aggreage. Each aggregate column is included as a json key.
+Several queries run at once, each as its own search job, and each is posted with its own
+category, host and fields when its .sqy file starts with lines such as:
+    // category: summary/volume
+    // fields: owner=ops
 
 Uses env vars:
 SUMO_URL - url HTTPS source to post records to
 SUMO_CATEGORY - sourcecategory
 SUMO_HOST - defaults to local host name
 SUMO_FIELDS - optional x-sumo-fields header
+SUMO_BATCH_BYTES - largest body posted to SUMO_URL, or use --batch-bytes
+SUMO_POST_WORKERS - batches posted at once, or use --post-workers
 DEFAULT_RANGE - time range for query, or use -r
-DEFAULT_QUERY - query to run or use -q
+DEFAULT_QUERY - query to run or use -q, either a query, a .sqy file, a directory of .sqy files,
+                or a json list of queries, each a string or {"name", "query", "category", "host", "fields"}
+SUMO_QUERY_WORKERS - queries run at once, or use -w
+SUMO_INTERVAL - with --daemon, run the queries every interval, defaults to the range
+SUMO_LIVENESS - with --daemon, a file kept fresh while the scheduler is alive, or use --liveness
+SUMO_INCREMENTAL - true, 1 or yes to run each query from where its last run left off, or use --incremental
+SUMO_OVERLAP - with --incremental, how far back past the last run to look again, or use --overlap
+SUMO_MAX_LOOKBACK - with --incremental, how far back a run catching up may start, or use --max-lookback
+SUMO_DEDUP_SIZE - with --incremental, records remembered so none is posted twice, or use --dedup-size
+SUMO_STATE_DIR - where the watermarks and the dedup index are kept, or use --state
 
 for reading events from the search job api
 SUMO_ACCESS_ID
@@ -38,20 +53,26 @@ __version__ = 0.1
 
 ### beginning ###
 import logging
+import gzip
+import hashlib
 import json
 import os
-#import sys
+import sys
 import argparse
 import http
 import re
 import time
-import random
-import multiprocessing
+import collections
+import concurrent.futures
+import queue
+import signal
+import threading
 from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
 import requests
-import datetime
-import math
+from sumolimit import RateLimiter, RetryBackoff, RETRY_STATUS, retry_safe
+from sumodedup import DedupIndex
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sumoprofile import start_profile
 
 kickoff_time=int(time.time())
 
@@ -64,8 +85,7 @@ logging.basicConfig(
 
 logger = logging.getLogger()
 
-if os.environ.get('SUMO_URL') is not None:
-    endpoint=os.environ['SUMO_URL']
+endpoint=os.environ.get('SUMO_URL')
 
 if endpoint is None:
     logger.fatal ("you must supply a sumo endpoint via env var SUMO_URl")
@@ -92,16 +112,44 @@ sumoquerysteam runs a query and streams resulting records to sumo url in JSON fo
 """)
 
 PARSER.add_argument("-e", metavar='<endpoint>', dest='MY_ENDPOINT', \
-                    help="set query endpoint (format: <dep>) or use env var SUMO_END")
-PARSER.add_argument("-q", metavar='<query>', dest='MY_QUERY', help="set query content or use env var DEFAULT_QUERY.")
+                    help="set query endpoint (format: <dep> or url) or use env var SUMO_END")
+PARSER.add_argument("-q", metavar='<query>', dest='MY_QUERY', \
+                    help="set query content, file or directory of .sqy files or use env var DEFAULT_QUERY.")
 PARSER.add_argument("-r", metavar='<range>', dest='MY_RANGE', default='15m', \
                     help="set query range or use env var DEFAULT_RANGE")
 PARSER.add_argument("-s", metavar='<sleeptime>', default=2, dest='SLEEPTIME', \
                     help="set sleep time to check results")
 PARSER.add_argument("-t", metavar='<timeflags>', default='mt', dest='TIME_FLAG', \
                     help="query by mt or rt")                 
+PARSER.add_argument("-w", metavar='<workers>', type=int, default=4, dest='WORKERS', \
+                    help="set queries run at once or use env var SUMO_QUERY_WORKERS")
+PARSER.add_argument("--daemon", default=False, action='store_true', dest='DAEMON', \
+                    help="keep running the queries at every interval, until stopped")
+PARSER.add_argument("--interval", metavar='<range>', dest='INTERVAL', \
+                    help="set interval between runs, aligned to the clock, or use env var SUMO_INTERVAL")
+PARSER.add_argument("--liveness", metavar='<file>', dest='LIVENESS', \
+                    help="set file written while the daemon is alive or use env var SUMO_LIVENESS")
+PARSER.add_argument("--incremental", default=False, action='store_true', dest='INCREMENTAL', \
+                    help="run each query from the watermark its last run left or use env var SUMO_INCREMENTAL")
+PARSER.add_argument("--overlap", metavar='<range>', default='0m', dest='OVERLAP', \
+                    help="set how far back past the watermark to look again or use env var SUMO_OVERLAP")
+PARSER.add_argument("--max-lookback", metavar='<range>', default='1d', dest='MAX_LOOKBACK', \
+                    help="set how far back a run catching up may start or use env var SUMO_MAX_LOOKBACK")
+PARSER.add_argument("--dedup-size", metavar='<records>', type=int, default=250000, dest='DEDUP_SIZE', \
+                    help="set records remembered as sent, 0 to not dedup, or use env var SUMO_DEDUP_SIZE")
+PARSER.add_argument("--state", metavar='<dir>', default='/var/tmp/sumoquerystream', dest='STATE_DIR', \
+                    help="set directory of watermarks and dedup index or use env var SUMO_STATE_DIR")
+PARSER.add_argument("--rate", metavar='<persecond>', type=float, default=4, dest='API_RATE', \
+                    help="set api calls per second for this access id or use env var SUMO_API_RATE")
+PARSER.add_argument("--batch-bytes", metavar='<bytes>', type=int, default=1000000, \
+                    dest='BATCH_BYTES', help="set largest body posted to SUMO_URL or use env var SUMO_BATCH_BYTES")
+PARSER.add_argument("--post-workers", metavar='<batches>', type=int, default=4, \
+                    dest='POST_WORKERS', help="set batches posted at once or use env var SUMO_POST_WORKERS")
+PARSER.add_argument("--profile", metavar='<path>', dest='PROFILE', \
+                    help="profile the run into files named after path or use env var SUMO_PROFILE")
 
 ARGS = PARSER.parse_args()
+start_profile(ARGS.PROFILE)
 
 if ARGS.MY_ENDPOINT:
     os.environ['SUMO_END']=ARGS.MY_ENDPOINT
@@ -133,6 +181,8 @@ DAY_H = 24
 WEEK_D = 7
 
 LIMIT = 10000
+
+POLL_STATES = ('NOT STARTED', 'GATHERING RESULTS', 'GATHERING RESULTS FROM SUBQUERIES')
 LONGQUERY_LIMIT = 100
 
 if os.environ.get('DEFAULT_QUERY') is not None:
@@ -144,17 +194,83 @@ else:
     '''
 
 if ARGS.MY_QUERY:
-    query=ARGS_MY_QUERY
+    query_source=ARGS.MY_QUERY
 else:
-    query=DEFAULT_QUERY
+    query_source=DEFAULT_QUERY
 
-# could be string most likely or list of queries
-if type(query) is str:
-    query_list=[query]
-else:
-    query_list=query
+QUERY_EXT = '.sqy'
+TIMESLICE_PATTERN = re.compile(r'\btimeslice\s+(?:by\s+)?(\d+[smhdw])\b', re.IGNORECASE)
+QUERY_DIRECTIVE = re.compile(r'^\s*//\s*(category|host|fields)\s*[:=]\s*(.*?)\s*$', re.IGNORECASE)
 
 MY_SLEEP = int(ARGS.SLEEPTIME)
+
+if os.environ.get('SUMO_API_RATE'):
+    api_rate=float(os.environ['SUMO_API_RATE'])
+else:
+    api_rate=ARGS.API_RATE
+
+if os.environ.get('SUMO_QUERY_WORKERS'):
+    query_workers=int(os.environ['SUMO_QUERY_WORKERS'])
+else:
+    query_workers=ARGS.WORKERS
+
+if os.environ.get('SUMO_INTERVAL'):
+    interval=os.environ['SUMO_INTERVAL']
+else:
+    interval=ARGS.INTERVAL or time_range
+
+if os.environ.get('SUMO_LIVENESS'):
+    liveness_file=os.environ['SUMO_LIVENESS']
+else:
+    liveness_file=ARGS.LIVENESS
+
+TRUE_VALUES = ('true', '1', 'yes')
+
+incremental = ARGS.INCREMENTAL or \
+    os.environ.get('SUMO_INCREMENTAL', '').strip().lower() in TRUE_VALUES
+
+if os.environ.get('SUMO_OVERLAP'):
+    overlap=os.environ['SUMO_OVERLAP']
+else:
+    overlap=ARGS.OVERLAP
+
+if os.environ.get('SUMO_MAX_LOOKBACK'):
+    max_lookback=os.environ['SUMO_MAX_LOOKBACK']
+else:
+    max_lookback=ARGS.MAX_LOOKBACK
+
+if os.environ.get('SUMO_DEDUP_SIZE'):
+    dedup_size=int(os.environ['SUMO_DEDUP_SIZE'])
+else:
+    dedup_size=ARGS.DEDUP_SIZE
+
+if os.environ.get('SUMO_STATE_DIR'):
+    state_dir=os.environ['SUMO_STATE_DIR']
+else:
+    state_dir=ARGS.STATE_DIR
+
+if os.environ.get('SUMO_BATCH_BYTES'):
+    batch_bytes=int(os.environ['SUMO_BATCH_BYTES'])
+else:
+    batch_bytes=ARGS.BATCH_BYTES
+
+if os.environ.get('SUMO_POST_WORKERS'):
+    post_workers=int(os.environ['SUMO_POST_WORKERS'])
+else:
+    post_workers=ARGS.POST_WORKERS
+
+GZIP_LEVEL = 6
+PIPELINE_PAGES = 4
+LIVENESS_S = 30
+SHUTDOWN = threading.Event()
+
+WATERMARK_FILE = os.path.join(state_dir, 'watermarks.json')
+WATERMARK_LOCK = threading.Lock()
+DEDUP_INDEX = None
+if incremental:
+    os.makedirs(state_dir, exist_ok=True)
+    if dedup_size > 0:
+        DEDUP_INDEX = DedupIndex(os.path.join(state_dir, 'dedup.idx'), dedup_size)
 NOW_TIME = kickoff_time * SEC_M
 
 TIME_TABLE = dict()
@@ -171,27 +287,6 @@ querycounter=0
 postcounter=0
 
 ### beginning ###
-def post_event(event,endpoint=None, category=None, host=None, fields=None, compressed=False):
-    if not endpoint:
-        raise ValueError('endpoint cannot be null')
-
-    headers = {"Content-type": "application/json"}
-
-    if compressed:
-        headers["Content-Encoding"] = "gzip"
-    if category:
-        headers["X-Sumo-Category"] = category
-    if host:
-        headers["X-Sumo-Host"] = host
-    if fields:
-        headers["X-Sumo-Fields"] = fields
-
-        # some code....
-    data = format_event(event,ts_strategy)
-
-    result= requests.post(endpoint, data, headers=headers)
-    return result
-
 def format_event(record,ts_strategy):
     logger.debug('timestamp strategy is: {}'.format(ts_strategy))
     # set default timestamp value
@@ -208,56 +303,190 @@ def format_event(record,ts_strategy):
 def main():
     """
     Setup the Sumo API connection, using the required tuple of region, id, and key.
-    Once done, then issue the command required
+    Once done, then issue the command required, once or with --daemon at every interval.
+    The queries, the api session and the posting session are set up once, and kept warm between runs.
     """
-    time_params = calculate_range(ARGS.TIME_FLAG)
-
-    logger.debug ("Time params: {}".format(time_params))
+    query_list = collect_queries(query_source)
+    logger.info('{} queries to run, {} at once'.format(len(query_list), query_workers))
 
     try:
-        apisession = SumoApiClient(SUMO_UID, SUMO_KEY, SUMO_END)
+        apisession = SumoApiClient(SUMO_UID, SUMO_KEY, SUMO_END, workers=query_workers)
 
     except Exception as exception:
         logger.fatal(exception)
         raise
     
-    records = process_request(apisession, query_list, time_params)
+    logger.info('Posting to SUMO_URL. endpoint={endpoint} category={category} host={host} fields={fields}'.format(endpoint=endpoint,category=category,host=host,fields=fields))
+    sink = EventSink(endpoint, category, host, fields)
+    if ARGS.DAEMON:
+        try:
+            run_daemon(apisession, query_list, sink)
+        finally:
+            sink.close()
+        return
 
-    if len(records) > 0:
-        logger.info('Posting to SUMO_URL. endpoint={endpoint} category={category} host={host} fields={fields}'.format(endpoint=endpoint,category=category,host=host,fields=fields))
-        for r in records:
-            result = post_event(r,endpoint,category,host,fields)
-        logger.info('Posting {} records completed'.format(len(records)))
-    else:
-        logger.warning('query returned 0 records')
+    try:
+        failures = run_queries(apisession, query_list, sink, NOW_TIME)
+    finally:
+        sink.close()
+
+    if failures:
+        logger.fatal('{} of {} queries failed'.format(failures, len(query_list)))
+        exit(1)
+
+def run_daemon(apisession, query_list, sink):
+    """
+    Run the queries at every interval, each run on a boundary of the wall clock,
+    so a 15m interval runs at :00, :15, :30 and :45 for the window ending then.
+    The first run is for the boundary just passed. Boundaries missed by a long
+    run are skipped. SIGTERM or SIGINT lets the running queries finish, skips
+    those not started, and leaves once what they sent is posted.
+    """
+    interval_ms = range_to_ms(interval)
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+    logger.info('SUMOQUERY.daemon: interval: {} liveness: {}'.format(interval, liveness_file))
 
-def process_request(apisession, query_list, time_params):
+    run_time = int(time.time() * SEC_M) // interval_ms * interval_ms
+    liveness = {'pid': os.getpid(), 'interval': interval, 'runs': 0, 'failures': 0}
+    try:
+        while not SHUTDOWN.is_set():
+            liveness.update(state='running', run_time=run_time)
+            write_liveness(liveness)
+            try:
+                failures = run_queries(apisession, query_list, sink, run_time)
+            except Exception as run_error:
+                logger.error('SUMOQUERY.run_failed: {} :: {}'.format(run_time, run_error))
+                failures = len(query_list)
+            liveness['runs'] += 1
+            liveness['failures'] = failures
+
+            next_time = run_time + interval_ms
+            now_time = int(time.time() * SEC_M)
+            if now_time >= next_time + interval_ms:
+                logger.warning('SUMOQUERY.skipped: {} runs, the last run took too long'.format( \
+                    (now_time - next_time) // interval_ms))
+                next_time = now_time // interval_ms * interval_ms
+            run_time = next_time
+            liveness.update(state='waiting', next_time=run_time)
+            wait_until(run_time, liveness)
+    finally:
+        if liveness_file and os.path.exists(liveness_file):
+            os.remove(liveness_file)
+        logger.info('SUMOQUERY.daemon: stopped after {} runs'.format(liveness['runs']))
+
+def run_queries(apisession, query_list, sink, run_time):
     """
-    perform the queries and process the output
+    Run every query once for the window ending at run_time, wait until all it sent
+    is posted, and log what the run posted. A query with a batch that failed to
+    post counts as failed. Only then are the watermarks of the
+    queries that completed moved on, and the records of the batches that were
+    posted kept as seen.
+    Returns the number of failed queries.
     """
+    TIME_TABLE['script_start'] = run_time
+    time_params = calculate_range(ARGS.TIME_FLAG, run_time)
+    logger.debug ("Time params: {}".format(time_params))
 
-    for query_data in query_list:
-        logger.debug('SUMOQUERY.query_data: {}'.format(query_data))
-        records = run_sumo_query(apisession, query_data, time_params)
+    sink_before = collections.Counter(sink.metrics)
+    api_before = collections.Counter(apisession.metrics)
+    (failures, windows) = process_request(apisession, query_list, time_params, sink)
+    try:
+        (post_failures, delivered) = sink.drain()
+    except Exception:
+        if DEDUP_INDEX is not None:
+            DEDUP_INDEX.rollback()
+        raise
+    if DEDUP_INDEX is not None:
+        DEDUP_INDEX.commit(delivered)
+    for query_name, post_error in post_failures.items():
+        logger.error('SUMOQUERY.post_failed: {} :: {}'.format(query_name, post_error))
+    failures += sum(1 for query_data, _window in windows if query_data['name'] in post_failures)
+    windows = [ (query_data, window) for query_data, window in windows \
+                if query_data['name'] not in post_failures ]
+    if incremental:
+        for query_data, window in windows:
+            if window is not None:
+                save_watermark(query_data['name'], time_to=window['time_to'], \
+                               query=query_digest(query_data))
+
+    sink_run = collections.Counter(sink.metrics)
+    sink_run.subtract(sink_before)
+    api_run = collections.Counter(apisession.metrics)
+    api_run.subtract(api_before)
+    if sink_run['events'] > 0:
+        logger.info('Posting {} records completed in {} batches, {} bytes sent'.format( \
+            sink_run['events'], sink_run['batches'], sink_run['bytes']))
+    else:
+        logger.warning('query returned 0 records')
 
-    return records
-        #time.sleep(random.randint(0,MY_SLEEP))
-    #time.sleep(random.randint(0,MY_SLEEP))
+    logger.info('api retries: {} retry wait: {:.1f}s'.format( \
+        api_run['retries'], api_run['retry_wait']))
+    return failures
 
-def calculate_range(time_flag):
+def request_shutdown(signum, _frame):
     """
-    This calculates time ranges based on range from current day
-    If specified "NNX to MMY" then NNX is start and MMY is finish
+    Ask the daemon to stop once the running queries are done
     """
+    logger.info('SUMOQUERY.daemon: {} received, stopping'.format(signal.Signals(signum).name))
+    SHUTDOWN.set()
 
-    number = 1
-    period = "h"
+def wait_until(run_time, liveness):
+    """
+    Wait for the wall clock to reach run_time, or for a shutdown, refreshing the liveness file as it waits
+    """
+    while not SHUTDOWN.is_set():
+        remaining = run_time / SEC_M - time.time()
+        if remaining <= 0:
+            return
+        write_liveness(liveness)
+        SHUTDOWN.wait(min(remaining, LIVENESS_S))
+
+def write_liveness(liveness):
+    """
+    Write the state of the daemon to the liveness file, replacing it in one step,
+    so an orchestrator can check both its age and its content
+    """
+    if not liveness_file:
+        return
+    liveness['updated'] = int(time.time())
+    scratch = liveness_file + '.' + str(os.getpid())
+    try:
+        with open(scratch, "w", encoding='utf8') as file_object:
+            json.dump(liveness, file_object)
+        os.replace(scratch, liveness_file)
+    except OSError as liveness_error:
+        logger.warning('SUMOQUERY.liveness: {} :: {}'.format(liveness_file, liveness_error))
 
-    number = re.match(r'\d+', time_range.replace('-', ''))
-    period = time_range.replace(number.group(), '')
+def process_request(apisession, query_list, time_params, sink):
+    """
+    perform the queries, up to query_workers at once, and stream the output of each
+    to the sink with the routing of its query. A failed query is logged and does
+    not stop the others. The number of failed queries is returned, along with
+    each completed query and the window it ran.
+    """
+    failures = 0
+    windows = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, query_workers)) as executor:
+        futures = { executor.submit(run_sumo_query, apisession, query_data, time_params, sink): \
+                    query_data for query_data in query_list }
+        for future in concurrent.futures.as_completed(futures):
+            query_data = futures[future]
+            try:
+                windows.append((query_data, future.result()))
+            except Exception as query_error:
+                failures += 1
+                logger.error('SUMOQUERY.failed: {} :: {}'.format(query_data['name'], query_error))
+    return (failures, windows)
+
+def calculate_range(time_flag, time_to=None):
+    """
+    This calculates time ranges based on range from current day, or from time_to when given
+    If specified "NNX to MMY" then NNX is start and MMY is finish
+    """
 
-    time_to = NOW_TIME
-    time_from = time_to - (int(number.group()) * int(TIME_TABLE[period]))
+    time_to = time_to or NOW_TIME
+    time_from = time_to - range_to_ms(time_range)
     TIME_PARAMS["time_to"] = time_to
     TIME_PARAMS["time_from"] = time_from
     TIME_PARAMS["time_zone"] = 'UTC'
@@ -266,27 +495,159 @@ def calculate_range(time_flag):
     else:
         TIME_PARAMS["by_receipt_time"] = False
 
-    return TIME_PARAMS
+    return dict(TIME_PARAMS)
+
+def calculate_window(query_data, time_params):
+    """
+    With --incremental this starts the window of a query at the watermark its
+    last run left, less the overlap, and snaps both ends back to the timeslice
+    of the query. Runs then query whole timeslices, each of them once, whatever
+    the jitter of the runs. Without a watermark for the query the range is run.
+    A watermark further back than the max lookback, after an outage or from a
+    stale state directory, starts the window at the max lookback instead.
+    """
+    window = dict(time_params)
+    if not incremental:
+        return window
+
+    watermark = load_watermarks().get(query_data['name'], {})
+    if watermark.get('query') == query_digest(query_data):
+        lookback_from = window["time_to"] - range_to_ms(max_lookback)
+        window["time_from"] = max(lookback_from, watermark["time_to"] - range_to_ms(overlap))
+        if window["time_from"] == lookback_from:
+            logger.warning('SUMOQUERY.lookback: {} watermark {} is older than {}, the gap is skipped'.format( \
+                query_data['name'], watermark["time_to"], max_lookback))
+    timeslice = TIMESLICE_PATTERN.search(query_data['query'])
+    if timeslice:
+        slice_ms = range_to_ms(timeslice.group(1))
+        window["time_to"] -= window["time_to"] % slice_ms
+        window["time_from"] -= window["time_from"] % slice_ms
+    return window
+
+def load_watermarks():
+    """
+    Read the watermarks, keyed by query name, a missing file reads as none
+    """
+    try:
+        with open(WATERMARK_FILE, "r", encoding='utf8') as file_object:
+            return json.load(file_object)
+    except (OSError, ValueError):
+        return {}
+
+def save_watermark(query_name, **watermark):
+    """
+    Record how far a query has been run, and the digest of the query that ran
+    """
+    with WATERMARK_LOCK:
+        watermarks = load_watermarks()
+        watermarks[query_name] = watermark
+        scratch = WATERMARK_FILE + '.' + str(os.getpid())
+        with open(scratch, "w", encoding='utf8') as file_object:
+            file_object.write(json.dumps(watermarks))
+        os.replace(scratch, WATERMARK_FILE)
+
+def query_digest(query_data):
+    """
+    A digest of the query text, so a watermark is dropped once the query changes
+    """
+    return hashlib.sha256(query_data['query'].encode('utf8')).hexdigest()[:16]
+
+def record_identity(query_data, record, key_names, window):
+    """
+    The identity of a record: its query, its grouping columns and its timeslice.
+    Without grouping columns from the api every column makes up the identity.
+    A record without a timeslice sums up its whole window, so the window takes
+    its place, otherwise every later run would look like the first.
+    """
+    key_names = sorted(set(key_names or record) | ({'_timeslice'} & set(record)))
+    key_parts = [ (name, record.get(name)) for name in key_names ]
+    if '_timeslice' not in record:
+        key_parts.append(('_window', window['time_from'], window['time_to']))
+    return DedupIndex.build_key(query_digest(query_data), key_parts)
+
+def range_to_ms(range_item):
+    """
+    Turn a range such as 15m or 1h into milliseconds
+    """
+    number = re.match(r'\d+', range_item.replace('-', ''))
+    period = range_item.replace('-', '').replace(number.group(), '', 1)
+    return int(number.group()) * int(TIME_TABLE[period])
 
-def collect_queries():
+def collect_queries(query_source):
     """
-    this version is simple -q only
+    Scoop up the queries to run, from a directory of .sqy files, a .sqy file,
+    a json list of queries or a query string. Each query is a dict of its name,
+    the query, and the category, host and fields its records are posted with.
     """
     query_list = []
-    if ARGS.MY_QUERY:
-            query_list.append(ARGS.MY_QUERY)
+    if os.path.isdir(query_source):
+        for root, dirs, files in os.walk(query_source):
+            dirs.sort()
+            for file in sorted(files):
+                if os.path.splitext(file)[1] == QUERY_EXT:
+                    query_list.append(read_query_file(os.path.join(root, file), query_source))
+    elif os.path.isfile(query_source):
+        query_list.append(read_query_file(query_source))
+    elif query_source.lstrip().startswith('['):
+        for number, query_item in enumerate(json.loads(query_source), 1):
+            if isinstance(query_item, str):
+                query_item = {'query': query_item}
+            query_name = query_item.get('name', 'query{:03d}'.format(number))
+            query_list.append(build_query(query_name, query_item['query'], query_item))
     else:
-        query_list.append(DEFAULT_QUERY)
-
+        query_list.append(build_query('query001', query_source))
     return query_list
 
-def run_sumo_query(apisession, query, time_params):
+def read_query_file(query_file, query_dir=None):
+    """
+    Read a .sqy file, taking its routing from // category:, // host: and // fields: lines.
+    A file found under query_dir is named by its path from there, so files of the
+    same name in different subdirectories stay apart, a lone file by its basename.
+    """
+    with open(query_file, "r", encoding='utf8') as file_object:
+        query = file_object.read()
+    routing = dict()
+    for line in query.splitlines():
+        directive = QUERY_DIRECTIVE.match(line)
+        if directive:
+            routing[directive.group(1).lower()] = directive.group(2)
+    if query_dir:
+        query_name = os.path.relpath(query_file, query_dir).replace(os.sep, '/')
+    else:
+        query_name = os.path.basename(query_file)
+    query_name = os.path.splitext(query_name)[0]
+    return build_query(query_name, query, routing)
+
+def build_query(query_name, query, routing=None):
     """
-    This runs the Sumo Command, and then saves the output and the status
+    Build a query definition, routed with the env var settings unless it has its own
     """
-    query_job = apisession.search_job(query, time_params)
+    routing = routing or dict()
+    return {'name': query_name, 'query': query, \
+            'category': routing.get('category') or category, \
+            'host': routing.get('host') or host, \
+            'fields': routing.get('fields') or fields}
+
+def run_sumo_query(apisession, query_data, time_params, sink):
+    """
+    This runs the Sumo Command, and then streams the records to the sink.
+    Pages are fetched on a thread of their own, at most PIPELINE_PAGES ahead
+    of the posting, so fetching and posting overlap in bounded memory.
+    Records the dedup index has seen sent before are dropped.
+    Returns the window the query ran, or None when it was already up to date.
+    """
+    logger.debug('SUMOQUERY.query_data: {}'.format(query_data))
+    if SHUTDOWN.is_set():
+        raise RuntimeError('skipped, shutting down')
+    window = calculate_window(query_data, time_params)
+    if window["time_from"] >= window["time_to"]:
+        logger.info('SUMOQUERY.uptodate: {}'.format(query_data['name']))
+        return None
+    logger.debug('SUMOQUERY.window: {} {}'.format(query_data['name'], window))
+    query_job = apisession.search_job(query_data['query'], window)
     query_jobid = query_job["id"]
-    logger.info('SUMOQUERY.jobid: {}'.format(query_jobid))
+    logger.info('SUMOQUERY.jobid: {} query: {}'.format(query_jobid, query_data['name']))
+    route = (query_data['category'], query_data['host'], query_data['fields'])
 
     (query_status, num_messages, num_records, iterations) = apisession.search_job_tally(query_jobid)
     logger.debug('SUMOQUERY.status: {}'.format(query_status))
@@ -294,44 +655,81 @@ def run_sumo_query(apisession, query, time_params):
     logger.debug('SUMOQUERY.messages: {}'.format(num_messages))
     logger.debug('SUMOQUERY.iterations: {}'.format(iterations))
 
-    assembled_output = build_assembled_output(apisession, query_jobid, num_records)
+    total_records = 0
+    duplicates = 0
+    for (key_names, records) in pipeline(fetch_record_pages(apisession, query_jobid, num_records)):
+        for record in records:
+            if DEDUP_INDEX is None:
+                sink.send(record, route, query_data['name'])
+                continue
+            digest = record_identity(query_data, record, key_names, window)
+            if DEDUP_INDEX.add(digest):
+                sink.send(record, route, query_data['name'], digest)
+            else:
+                duplicates += 1
+        total_records = total_records + len(records)
+
+    logger.info('total records collected for query {}: {}'.format(query_data['name'], total_records))
+    if duplicates:
+        logger.info('duplicate records dropped for query {}: {}'.format(query_data['name'], duplicates))
     logger.info('Completed collecting results for query: {}'.format(query_jobid))
-    return assembled_output
+    return window
 
-def build_assembled_output(apisession, query_jobid, num_records):
+def fetch_record_pages(apisession, query_jobid, num_records):
     """
-    This assembles the header and output, going through the iterations of the output
-    Can return a records list object if OUT_FORMAT == json
+    This goes through the pages of the output, yielding the records of each page
+    along with the names of the grouping columns
     """
-    
-    records = []
-    if num_records == 0:
-        assembled_output = []
-    else:
-        total_records = 0
-        iterations = math.ceil(num_records/LIMIT)
-        for my_counter in range(0, iterations, 1):
-            my_limit = LIMIT
-            my_offset = ( my_limit * my_counter )
-
-            query_records = apisession.search_job_records(query_jobid, my_limit, my_offset)
-            # code loops 1 time too many
-            if my_counter ==0:
-                records=extract_record_list(query_records["records"])
-            elif len(query_records["records"]) > 0:
-                records.append(extract_record_list(query_records["records"]))
-
-            collected_records=len(records)
-            total_records = total_records + collected_records
-
-            logger.debug('Collected {} records'.format(collected_records))
-
-        logger.info('total records collected for query: {}'.format(total_records))
-
-        assembled_output = records
-        
-    return assembled_output
-
+    for my_offset in range(0, num_records, LIMIT):
+        query_records = apisession.search_job_records(query_jobid, LIMIT, my_offset)
+        records = extract_record_list(query_records["records"])
+        logger.debug('Collected {} records'.format(len(records)))
+        if not records:
+            break
+        yield ([ field['name'] for field in query_records.get("fields", []) \
+                 if field.get('keyField') ], records)
+
+def pipeline(pages, depth=PIPELINE_PAGES):
+    """
+    Runs a generator on a thread of its own, handing what it yields over through
+    a queue of up to depth items. When the consumer stops early, the thread is
+    told to stop, and an error raised on the thread is raised to the consumer.
+    """
+    handoff = queue.Queue(maxsize=depth)
+    stopping = threading.Event()
+    finished = object()
+
+    def hand_over(item):
+        while not stopping.is_set():
+            try:
+                handoff.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for page in pages:
+                if not hand_over((page, None)):
+                    return
+            hand_over((finished, None))
+        except Exception as error:
+            hand_over((finished, error))
+
+    producer = threading.Thread(target=produce, name='pipeline', daemon=True)
+    producer.start()
+    try:
+        while True:
+            (page, error) = handoff.get()
+            if page is finished:
+                if error is not None:
+                    raise error
+                return
+            yield page
+    finally:
+        stopping.set()
+        producer.join()
 
 def extract_record_list(query_records):
     """
@@ -355,17 +753,12 @@ class SumoApiClient():
     The class includes the HTTP methods, cmdlets, and init methods
     """
 
-    def __init__(self, access_id, access_key, region, cookieFile='cookies.txt'):
+    def __init__(self, access_id, access_key, region, cookieFile='cookies.txt', workers=1):
         """
-        Initializes the Sumo Logic object
+        Initializes the Sumo Logic object, pooling a connection for each query run at once
         """
 
-        self.retry_strategy = Retry(
-            total=10,
-            status_forcelist=[429, 500, 502, 503, 504],
-            allowed_methods=["HEAD", "GET", "OPTIONS"]
-        )
-        self.adapter = HTTPAdapter(max_retries=self.retry_strategy)
+        self.adapter = HTTPAdapter(pool_maxsize=max(10, workers * 2))
 
         self.session = requests.Session()
 
@@ -375,53 +768,75 @@ class SumoApiClient():
         self.session.auth = (access_id, access_key)
         self.session.headers = {'content-type': 'application/json', \
             'accept': 'application/json'}
-        self.endpoint = 'https://api.' + region + '.sumologic.com/api'
+        self.limiter = RateLimiter(access_id, api_rate)
+        self.metrics = collections.Counter()
+        self.metrics_lock = threading.Lock()
+        if region.startswith('http'):
+            self.endpoint = region
+        else:
+            self.endpoint = 'https://api.' + region + '.sumologic.com/api'
         cookiejar = http.cookiejar.FileCookieJar(cookieFile)
         self.session.cookies = cookiejar
 
-    def delete(self, method, params=None, headers=None, data=None):
+    def _request(self, verb, method, **kwargs):
         """
-        Defines a Sumo Logic Delete operation
+        Sends a request through the rate limiter, retrying throttled and failed ones.
+        A broken connection only retries a search job POST when it never got through,
+        see retry_safe; this client does not delete jobs, so one started by a POST
+        cut off midway is left until the server expires it.
+        Each retry and its wait are counted in the client metrics.
         """
-        response = self.session.delete(self.endpoint + method, \
-            params=params, headers=headers, data=data)
+        backoff = RetryBackoff()
+        while True:
+            self.limiter.acquire()
+            request_error = None
+            try:
+                response = self.session.request(verb, self.endpoint + method, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+                (response, request_error) = (None, error)
+            if request_error is not None and not retry_safe(verb, request_error):
+                raise request_error
+            if response is not None and response.status_code not in RETRY_STATUS:
+                break
+            wait = backoff.wait(response)
+            if wait is None:
+                if request_error is not None:
+                    raise request_error
+                break
+            with self.metrics_lock:
+                self.metrics['retries'] += 1
+                self.metrics['retry_wait'] += wait
+            time.sleep(wait)
         if response.status_code != 200:
             response.reason = response.text
         response.raise_for_status()
         return response
 
+    def delete(self, method, params=None, headers=None, data=None):
+        """
+        Defines a Sumo Logic Delete operation
+        """
+        return self._request('DELETE', method, params=params, headers=headers, data=data)
+
     def get(self, method, params=None, headers=None):
         """
         Defines a Sumo Logic Get operation
         """
-        response = self.session.get(self.endpoint + method, \
-            params=params, headers=headers)
-        if response.status_code != 200:
-            response.reason = response.text
-        response.raise_for_status()
-        return response
+        return self._request('GET', method, params=params, headers=headers)
 
     def post(self, method, data, headers=None, params=None):
         """
         Defines a Sumo Logic Post operation
         """
-        response = self.session.post(self.endpoint + method, \
-            data=json.dumps(data), headers=headers, params=params)
-        if response.status_code != 200:
-            response.reason = response.text
-        response.raise_for_status()
-        return response
+        return self._request('POST', method, data=json.dumps(data), headers=headers, \
+                             params=params)
 
     def put(self, method, data, headers=None, params=None):
         """
         Defines a Sumo Logic Put operation
         """
-        response = self.session.put(self.endpoint + method, \
-            data=json.dumps(data), headers=headers, params=params)
-        if response.status_code != 200:
-            response.reason = response.text
-        response.raise_for_status()
-        return response
+        return self._request('PUT', method, data=json.dumps(data), headers=headers, \
+                             params=params)
 
 ### class ###
 ### methods ###
@@ -476,14 +891,13 @@ class SumoApiClient():
         query_status = query_output['state']
         num_messages = query_output['messageCount']
         num_records = query_output['recordCount']
-        time.sleep(random.randint(0,MY_SLEEP))
         iterations = 1
-        while query_status == 'GATHERING RESULTS':
+        while query_status in POLL_STATES:
+            time.sleep(MY_SLEEP)
             query_output = self.search_job_status(query_jobid)
             query_status = query_output['state']
             num_messages = query_output['messageCount']
             num_records = query_output['recordCount']
-            time.sleep(random.randint(0,MY_SLEEP))
             iterations += 1
         return (query_status, num_messages, num_records, iterations)
 
@@ -503,8 +917,179 @@ class SumoApiClient():
         response = self.get('/v1/search/jobs/' + str(query_jobid) + '/records', params)
         return json.loads(response.text)
 
-
 ### methods ###
 
+### class ###
+class EventSink():
+    """
+    This posts records to a Sumo HTTP source in batches. Records are packed one
+    json object a line into a body of up to batch_bytes, which is gzipped and
+    posted on a pooled session, with up to post_workers batches in flight.
+    Each route, a category, host and fields, is batched and posted with headers
+    of its own, and records can be sent from several threads at once.
+    Throttled and failed posts are retried the same way api calls are.
+    Records are batched apart for each owner, such as a query, and a batch that
+    still fails is kept against its owner, to be handed back by drain().
+    A record can carry a key, the keys of every batch posted are handed back too.
+    """
+
+    def __init__(self, url, category=None, host=None, fields=None, \
+                 max_bytes=None, workers=None):
+        """
+        Initializes the session, the default route and the pool posting the batches
+        """
+        if not url:
+            raise ValueError('url cannot be null')
+        self.url = url
+        self.route = (category, host, fields)
+        self.max_bytes = max_bytes or batch_bytes
+        workers = max(1, workers or post_workers)
+
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session = requests.Session()
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.session.headers.update({'Content-Type': 'application/json', \
+                                     'Content-Encoding': 'gzip'})
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.workers = workers
+        self.in_flight = collections.deque()
+        self.batches = dict()
+        self.sizes = collections.Counter()
+        self.failures = dict()
+        self.keys = dict()
+        self.delivered = []
+        self.lock = threading.RLock()
+        self.metrics = collections.Counter()
+        self.metrics_lock = threading.Lock()
+
+    def send(self, record, route=None, owner=None, key=None):
+        """
+        Add a record to the batch of its owner and route, posting the batch first if the record would not fit
+        """
+        line = format_event(record, ts_strategy).encode('utf8')
+        batch_key = (owner, route or self.route)
+        with self.lock:
+            if self.batches.get(batch_key) and \
+                    self.sizes[batch_key] + len(line) + 1 > self.max_bytes:
+                self._submit(batch_key)
+            self.batches.setdefault(batch_key, []).append(line)
+            self.sizes[batch_key] += len(line) + 1
+            if key is not None:
+                self.keys.setdefault(batch_key, []).append(key)
+
+    def flush(self):
+        """
+        Post the batch of every owner and route
+        """
+        with self.lock:
+            for batch_key in list(self.batches):
+                self._submit(batch_key)
+
+    def _submit(self, batch_key):
+        """
+        Post a batch, waiting for the oldest batch in flight when all workers are busy.
+        How the batch fares is kept by _deliver, nothing is raised here.
+        """
+        lines = self.batches.pop(batch_key, None)
+        self.sizes.pop(batch_key, None)
+        keys = self.keys.pop(batch_key, [])
+        if not lines:
+            return
+        while len(self.in_flight) >= self.workers:
+            concurrent.futures.wait([self.in_flight.popleft()])
+        (owner, route) = batch_key
+        body = b'\n'.join(lines)
+        future = self.executor.submit(self._deliver, owner, keys, body, len(lines), \
+                                      route_headers(route))
+        self.in_flight.append(future)
+
+    def _deliver(self, owner, keys, body, num_events, headers):
+        """
+        Post a batch, keeping the first failed batch of an owner or the keys of a
+        batch that was posted. This is done in the task, not in a done callback,
+        so it is kept by the time anything waiting on the task wakes up.
+        """
+        try:
+            self._post(body, num_events, headers)
+        except Exception as post_error:
+            with self.metrics_lock:
+                self.failures.setdefault(owner, post_error)
+            return
+        with self.metrics_lock:
+            self.delivered.extend(keys)
+
+    def drain(self):
+        """
+        Post what is left and wait for every batch in flight. Returns the first
+        failure of each owner with a failed batch since the last drain, and the
+        keys of the records posted since then.
+        """
+        self.flush()
+        with self.lock:
+            concurrent.futures.wait(self.in_flight)
+            self.in_flight.clear()
+        with self.metrics_lock:
+            (failures, self.failures) = (self.failures, dict())
+            (delivered, self.delivered) = (self.delivered, [])
+        return (failures, delivered)
+
+    def close(self):
+        """
+        Post what is left, wait for every batch, and raise the first failure not yet handed back
+        """
+        try:
+            (failures, _delivered) = self.drain()
+            if failures:
+                raise next(iter(failures.values()))
+        finally:
+            self.executor.shutdown(wait=True)
+            self.session.close()
+
+    def _post(self, body, num_events, headers=None):
+        """
+        Compress and post one batch, retrying throttled and failed posts
+        """
+        data = gzip.compress(body, compresslevel=GZIP_LEVEL)
+        backoff = RetryBackoff()
+        while True:
+            request_error = None
+            try:
+                response = self.session.post(self.url, data=data, headers=headers)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+                (response, request_error) = (None, error)
+            if response is not None and response.status_code not in RETRY_STATUS:
+                break
+            wait = backoff.wait(response)
+            if wait is None:
+                if request_error is not None:
+                    raise request_error
+                break
+            logger.debug('post retry in {:.1f}s'.format(wait))
+            time.sleep(wait)
+        response.raise_for_status()
+        with self.metrics_lock:
+            self.metrics['events'] += num_events
+            self.metrics['batches'] += 1
+            self.metrics['bytes'] += len(data)
+        return response
+
+### class ###
+
+def route_headers(route):
+    """
+    The X-Sumo headers of a route of category, host and fields, leaving out those not set
+    """
+    (route_category, route_host, route_fields) = route
+    headers = dict()
+    if route_category:
+        headers['X-Sumo-Category'] = route_category
+    if route_host:
+        headers['X-Sumo-Host'] = route_host
+    if route_fields:
+        headers['X-Sumo-Fields'] = route_fields
+    return headers
+
 if __name__ == '__main__':
     main()
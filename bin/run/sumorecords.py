@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Exaplanation: sumorecords serializes search job record and message pages for the run cmdlets
+
+Usage:
+   from sumorecords import RecordSerializer, MessageSerializer
+
+   $ python  sumorecords [ -n <rows> ] [ -c <columns> ]
+
+   Run on its own it benchmarks rows/sec on synthetic record pages
+
+Style:
+   Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+    @name           sumorecords
+    @version        1.00
+    @author-name    Wayne Schmidt
+    @author-email   wschmidt@sumologic.com
+    @license-name   Apache 2.0
+    @license-url    http://www.gnu.org/licenses/gpl.html
+"""
+
+__version__ = 1.00
+__author__ = "Wayne Schmidt (wschmidt@sumologic.com)"
+
+### beginning ###
+import argparse
+import csv
+import io
+import json
+import operator
+import time
+
+CSV_SEP = ','
+EOL_SEP = '\n'
+
+PAGE_SIZE = 10000
+
+### beginning ###
+
+### class ###
+class RecordSerializer():
+    """
+    This turns the records of a search job into delimited text.
+    The field order is read once from the fields of the first page, and each
+    record becomes a row with one lookup. A page of plain values is joined in
+    one pass; a page with values holding the delimiter, quotes or line breaks
+    goes through the csv writer, which quotes them.
+    """
+
+    def __init__(self, fields, delimiter=CSV_SEP):
+        """
+        Sets up the field order, the row getter and the csv writer
+        """
+        self.header_list = [ field['name'] for field in fields ]
+        self.getter = operator.itemgetter(*self.header_list) if self.header_list else None
+        self.delimiter = delimiter
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, delimiter=delimiter, lineterminator=EOL_SEP)
+
+    def rows(self, records):
+        """
+        Pull the values of each record out in field order
+        """
+        if self.getter is None:
+            return [ () for _record in records ]
+        try:
+            rows = [ self.getter(record['map']) for record in records ]
+        except KeyError:
+            rows = [ tuple(record['map'].get(header, '') for header in self.header_list) \
+                     for record in records ]
+        if len(self.header_list) == 1 and rows and not isinstance(rows[0], tuple):
+            rows = [ (row,) for row in rows ]
+        return rows
+
+    def format(self, rows):
+        """
+        Serialize rows to text, each ending in a line break
+        """
+        if not rows:
+            return ''
+        try:
+            text = EOL_SEP.join(map(self.delimiter.join, rows))
+        except TypeError:
+            text = None
+        if text is not None and self._plain(text, rows):
+            return text + EOL_SEP
+
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.writer.writerows(rows)
+        return self.buffer.getvalue()
+
+    def _plain(self, text, rows):
+        """
+        Tells whether joined rows came out the same as the csv writer would
+        write them, with no value that needs quoting
+        """
+        width = len(rows[0])
+        if width == 1 and not all(row[0] for row in rows):
+            return False
+        return text.count(self.delimiter) == len(rows) * (width - 1) \
+            and text.count(EOL_SEP) == len(rows) - 1 \
+            and '"' not in text and '\r' not in text
+
+    def header(self):
+        """
+        Serialize the header row
+        """
+        return self.format([self.header_list])
+
+    def page(self, query_records):
+        """
+        Serialize every record of a page
+        """
+        return self.format(self.rows(query_records['records']))
+
+class MessageSerializer():
+    """
+    This turns the messages of a search job into newline delimited json,
+    one object of message fields per line. It has no header, and otherwise
+    works the same way as RecordSerializer so outputs can take either.
+    """
+
+    def __init__(self, fields=None):
+        """
+        Sets up the json encoder, messages have no header
+        """
+        self.header_list = []
+        self.fields = fields
+        self.encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+    @staticmethod
+    def rows(messages):
+        """
+        Pull the field map out of each message
+        """
+        return [ message['map'] for message in messages ]
+
+    def format(self, rows):
+        """
+        Serialize message maps to text, each on a line of its own
+        """
+        if not rows:
+            return ''
+        return EOL_SEP.join(map(self.encoder.encode, rows)) + EOL_SEP
+
+    def page(self, query_messages):
+        """
+        Serialize every message of a page
+        """
+        return self.format(self.rows(query_messages['messages']))
+
+### class ###
+
+def build_pages(num_rows, num_columns):
+    """
+    This builds synthetic record pages shaped like the search job api returns
+    """
+    fields = [ {'name': f'field{column:02d}', 'fieldType': 'string', 'keyField': False} \
+               for column in range(num_columns) ]
+    pages = []
+    for page_start in range(0, num_rows, PAGE_SIZE):
+        records = [ {'map': { field['name']: f'value {row}-{column}' \
+                              for column, field in enumerate(fields) }} \
+                    for row in range(page_start, min(page_start + PAGE_SIZE, num_rows)) ]
+        pages.append({'fields': fields, 'records': records})
+    return pages
+
+def legacy_page(query_records, header_list):
+    """
+    This is the per cell join the cmdlets used before RecordSerializer, kept to compare
+    """
+    record_body_list = []
+    for record in query_records["records"]:
+        record_line_list = []
+        for header in header_list:
+            recordlist = str(record["map"][header]).replace(',','|')
+            record_line_list.append(recordlist)
+            record_line = CSV_SEP.join(record_line_list)
+        record_body_list.append(record_line)
+    return EOL_SEP.join(record_body_list)
+
+def main():
+    """
+    Time both serializers over the same synthetic pages and report rows/sec
+    """
+    parser = argparse.ArgumentParser(description="""
+    sumorecords benchmarks record serialization
+    """)
+    parser.add_argument("-n", metavar='<rows>', type=int, default=1000000, dest='ROWS', \
+                        help="set number of synthetic rows")
+    parser.add_argument("-c", metavar='<columns>', type=int, default=8, dest='COLUMNS', \
+                        help="set number of columns per row")
+    args = parser.parse_args()
+
+    pages = build_pages(args.ROWS, args.COLUMNS)
+    header_list = [ field['name'] for field in pages[0]['fields'] ]
+
+    start_time = time.perf_counter()
+    for query_records in pages:
+        legacy_page(query_records, header_list)
+    legacy_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    serializer = RecordSerializer(pages[0]['fields'])
+    for query_records in pages:
+        serializer.page(query_records)
+    serializer_time = time.perf_counter() - start_time
+
+    print(f'rows: {args.ROWS} columns: {args.COLUMNS} pages: {len(pages)}')
+    print(f'legacy: {args.ROWS / legacy_time:,.0f} rows/sec ({legacy_time:.2f}s)')
+    print(f'serializer: {args.ROWS / serializer_time:,.0f} rows/sec ({serializer_time:.2f}s)')
+
+if __name__ == '__main__':
+    main()
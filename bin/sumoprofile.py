@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Exaplanation: sumoprofile profiles a whole cmdlet run, and merges the profiles it leaves
+
+Usage:
+   from sumoprofile import start_profile
+
+   $ SUMO_PROFILE=/var/tmp/profiles ./bin/run/sumoquery.py ...
+   $ ./bin/run/sumoquery.py --profile /var/tmp/profiles/nightly ...
+   $ python  sumoprofile [ -n <top> ] [ -o <merged> ] profile ...
+
+   A profile path that is a directory gets files named after the cmdlet.
+   By default each thread of each process writes a cProfile dump of its own,
+   <path>.<pid>.<thread>.prof. With SUMO_PROFILE_INTERVAL set in milliseconds,
+   the stacks of every thread are sampled at that interval instead, and each
+   process writes one <path>.<pid>.stacks of collapsed stacks, ready for a flame graph.
+   Processes forked or spawned by the cmdlet profile themselves the same way.
+   Run on its own, it merges profiles and lists the functions taking the most time.
+
+Style:
+   Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+    @name           sumoprofile
+    @version        1.00
+    @author-name    Wayne Schmidt
+    @author-email   wschmidt@sumologic.com
+    @license-name   Apache 2.0
+    @license-url    http://www.gnu.org/licenses/gpl.html
+"""
+
+__version__ = 1.00
+__author__ = "Wayne Schmidt (wschmidt@sumologic.com)"
+
+### beginning ###
+import atexit
+import collections
+import marshal
+import os
+import sys
+import threading
+
+PROFILE_ENV = 'SUMO_PROFILE'
+INTERVAL_ENV = 'SUMO_PROFILE_INTERVAL'
+
+PROFILE_EXT = '.prof'
+STACKS_EXT = '.stacks'
+
+STACK_SEP = ';'
+
+MS_S = 1000
+
+### beginning ###
+
+def start_profile(profile_path=None):
+    """
+    Profile the rest of the run if a profile path is given, or set in SUMO_PROFILE.
+    Returns the profiler, or None when not profiling.
+    """
+    profile_path = profile_path or os.environ.get(PROFILE_ENV)
+    if not profile_path:
+        return None
+    if os.path.isdir(profile_path):
+        cmdlet = os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'python'
+        profile_path = os.path.join(profile_path, cmdlet)
+
+    interval = float(os.environ.get(INTERVAL_ENV) or 0) / MS_S
+    if interval > 0:
+        profiler = StackSampler(profile_path, interval)
+    else:
+        profiler = ThreadProfiler(profile_path)
+
+    os.environ.setdefault(PROFILE_ENV, profile_path)
+    profiler.start()
+    atexit.register(profiler.stop)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=profiler.restart)
+    return profiler
+
+def stop_at_worker_exit(profiler):
+    """
+    Forked multiprocessing workers leave without running atexit, but do run
+    the multiprocessing finalizers. Their finalizers are cleared as a worker
+    starts, so the finalizer stopping the profiler is added once that is done.
+    """
+    if 'multiprocessing' in sys.modules:
+        import multiprocessing.util
+        multiprocessing.util.register_after_fork(profiler, add_worker_finalizer)
+
+def add_worker_finalizer(profiler):
+    """
+    Stop the profiler when a multiprocessing worker exits
+    """
+    import multiprocessing.util
+    multiprocessing.util.Finalize(None, profiler.stop, exitpriority=100)
+
+### class ###
+class ThreadProfiler():
+    """
+    This runs a cProfile profiler in every thread of the process, each dumped
+    to a file of its own, so profiles of a run can be merged with pstats.
+    Threads started before profiling, or a python that only allows one
+    profiler at a time, are covered by the profiler of the main thread alone.
+    """
+
+    def __init__(self, profile_path):
+        """
+        Initializes the profile path, and the list of thread profilers
+        """
+        self.profile_path = profile_path
+        self.profilers = []
+        self.lock = threading.Lock()
+        self.stopped = False
+
+    def start(self):
+        """
+        Profile the current thread, and every thread started from now on
+        """
+        self.stopped = False
+        self._profile_thread()
+        threading.setprofile(self._bootstrap)
+
+    def restart(self):
+        """
+        Start afresh in a forked child, the parent's profiles are not ours to write.
+        The inherited profilers are disabled first, or dropping them would
+        unset the profiler of this thread.
+        """
+        for _thread_name, profiler in self.profilers:
+            profiler.disable()
+        self.profilers = []
+        self.lock = threading.Lock()
+        self.start()
+        stop_at_worker_exit(self)
+
+    def stop(self):
+        """
+        Stop profiling and write a file for each thread that was profiled
+        """
+        with self.lock:
+            if self.stopped:
+                return
+            self.stopped = True
+            profilers = list(self.profilers)
+        threading.setprofile(None)
+        current_profiler = sys.getprofile()
+        for thread_name, profiler in profilers:
+            if profiler is current_profiler:
+                profiler.disable()
+            profiler.snapshot_stats()
+            profile_file = f'{self.profile_path}.{os.getpid()}.{thread_name}{PROFILE_EXT}'
+            try:
+                with open(profile_file, "wb") as file_object:
+                    marshal.dump(profiler.stats, file_object)
+            except OSError as profile_error:
+                print(f'SUMOPROFILE.error: {profile_file} :: {profile_error}', file=sys.stderr)
+
+    def _bootstrap(self, _frame, _event, _arg):
+        """
+        Installed by threading.setprofile, this swaps itself for a profiler of the new thread
+        """
+        sys.setprofile(None)
+        if not self.stopped:
+            self._profile_thread()
+
+    def _profile_thread(self):
+        """
+        Start a profiler on the current thread
+        """
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            return
+        thread_name = threading.current_thread().name.replace(os.sep, '_').replace(' ', '_')
+        with self.lock:
+            if any(name == thread_name for name, _profiler in self.profilers):
+                thread_name = f'{thread_name}-{threading.get_ident()}'
+            self.profilers.append((thread_name, profiler))
+
+class StackSampler():
+    """
+    This samples the stacks of every thread from a thread of its own, counting
+    how often each stack is seen. It costs the run one stack walk per interval
+    whatever the run is doing, so it is cheap enough to leave on in production.
+    """
+
+    def __init__(self, profile_path, interval):
+        """
+        Initializes the profile path, the interval and the stack counts
+        """
+        self.profile_path = profile_path
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.done = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Start the sampling thread
+        """
+        self.done.clear()
+        self.thread = threading.Thread(target=self._sample, name='sumoprofile', daemon=True)
+        self.thread.start()
+
+    def restart(self):
+        """
+        Start afresh in a forked child, where the sampling thread did not survive
+        """
+        self.stacks = collections.Counter()
+        self.done = threading.Event()
+        self.start()
+        stop_at_worker_exit(self)
+
+    def stop(self):
+        """
+        Stop sampling and write the stack counts, one collapsed stack a line
+        """
+        if self.done.is_set():
+            return
+        self.done.set()
+        self.thread.join()
+        profile_file = f'{self.profile_path}.{os.getpid()}{STACKS_EXT}'
+        try:
+            with open(profile_file, "w", encoding='utf8') as file_object:
+                for stack, count in self.stacks.most_common():
+                    file_object.write(f'{stack} {count}\n')
+        except OSError as profile_error:
+            print(f'SUMOPROFILE.error: {profile_file} :: {profile_error}', file=sys.stderr)
+
+    def _sample(self):
+        """
+        Count the stack of every other thread once an interval
+        """
+        own_ident = threading.get_ident()
+        while not self.done.wait(self.interval):
+            thread_names = { thread.ident: thread.name for thread in threading.enumerate() }
+            for ident, frame in sys._current_frames().items():
+                if ident != own_ident:
+                    self.stacks[collapse_stack(thread_names.get(ident, str(ident)), frame)] += 1
+
+### class ###
+
+def collapse_stack(thread_name, frame):
+    """
+    Turn a stack into one line, outermost frame first, rooted at its thread
+    """
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    frames.append(thread_name.replace(STACK_SEP, '_'))
+    return STACK_SEP.join(reversed(frames))
+
+def merge_profiles(profile_files, merged_file=None, top=25):
+    """
+    Merge cProfile dumps and list the functions with the most cumulative time,
+    or add up collapsed stacks and list the stacks seen most
+    """
+    prof_files = [ profile_file for profile_file in profile_files \
+                   if not profile_file.endswith(STACKS_EXT) ]
+    stack_files = [ profile_file for profile_file in profile_files \
+                    if profile_file.endswith(STACKS_EXT) ]
+    if prof_files:
+        import pstats
+        stats = pstats.Stats(*prof_files)
+        if merged_file:
+            stats.dump_stats(merged_file)
+        stats.sort_stats('cumulative').print_stats(top)
+    if stack_files:
+        stacks = collections.Counter()
+        for stack_file in stack_files:
+            with open(stack_file, "r", encoding='utf8') as file_object:
+                for line in file_object:
+                    (stack, _sep, count) = line.rstrip().rpartition(' ')
+                    stacks[stack] += int(count)
+        if merged_file:
+            with open(merged_file, "w", encoding='utf8') as file_object:
+                for stack, count in stacks.most_common():
+                    file_object.write(f'{stack} {count}\n')
+        total = sum(stacks.values()) or 1
+        for stack, count in stacks.most_common(top):
+            print(f'{count / total:6.1%} {count:8d}  {stack}')
+
+def main():
+    """
+    Merge the profiles named on the command line
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description="""
+    sumoprofile merges the profiles of a run and lists where it spent its time
+    """)
+    parser.add_argument("-n", metavar='<top>', type=int, default=25, dest='TOP', \
+                        help="set number of functions or stacks listed")
+    parser.add_argument("-o", metavar='<merged>', dest='MERGED', \
+                        help="also write the merged profile to a file")
+    parser.add_argument("profiles", metavar='profile', nargs='+', \
+                        help="cProfile .prof dumps or sampled .stacks files")
+    args = parser.parse_args()
+    merge_profiles(args.profiles, args.MERGED, args.TOP)
+
+if __name__ == '__main__':
+    main()
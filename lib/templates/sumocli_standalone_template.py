@@ -7,6 +7,9 @@ Exaplanation: sumo_logic_template is a Sumo Logic cmdlet
 Usage:
    $ python  sumo_logic_template [ options ]
 
+   Copy it into a bin/<group>/ directory before running it, it imports
+   sumoprofile from bin/ and will not start from lib/templates/.
+
 Style:
    Google Python Style Guide:
    http://google.github.io/styleguide/pyguide.html
@@ -31,6 +34,9 @@ import argparse
 import http
 import requests
 sys.dont_write_bytecode = 1
+# sumoprofile lives in bin/, so the cmdlet has to sit in a bin/<group>/ directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sumoprofile import start_profile
 
 MY_CFG = 'undefined'
 PARSER = argparse.ArgumentParser(description="""
@@ -45,8 +51,11 @@ PARSER.add_argument("-e", metavar='<endpoint>', default='us2', dest='MY_ENDPOINT
                     help="set endpoint (format: <endpoint>) ")
 PARSER.add_argument("-v", type=int, default=0, metavar='<verbose>', \
                     dest='VERBOSE', help="increase verbosity")
+PARSER.add_argument("--profile", metavar='<path>', dest='PROFILE', \
+                    help="profile the run into files named after path or use env var SUMO_PROFILE")
 
 ARGS = PARSER.parse_args()
+start_profile(ARGS.PROFILE)
 
 LIMIT = 10000
 LONGQUERY_LIMIT = 100